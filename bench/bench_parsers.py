@@ -0,0 +1,85 @@
+"""Сравнение движков разбора HTML на сохраненных страницах каталогов.
+
+Запуск из корня репозитория:
+    python bench/bench_parsers.py [--repeat 20]
+
+Для каждой страницы проверяется, что все движки извлекают одинаковые товары,
+и выводится среднее время разбора одной страницы. При расхождении результатов
+скрипт завершается с кодом 1.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT, "bench", "fixtures")
+
+# Модуль бота требует токен при импорте; для замеров подойдет любой
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, ROOT)
+
+import botetmpars  # noqa: E402
+
+# Фикстура -> источник, чьи селекторы к ней применяются
+FIXTURES = {
+    "dns_shop.html": "DNS-Shop",
+    "citilink.html": "Citilink",
+}
+
+def comparable(products):
+    """Товары без поля времени, которое отличается между запусками"""
+    return [(product.id, product.name, product.price, product.link, product.source) for product in products]
+
+def run(repeat):
+    """Замер всех движков на всех фикстурах; возвращает True, если результаты совпали"""
+    monitor = botetmpars.PriceMonitor()
+    # Эталон - исходный движок на BeautifulSoup
+    backends = sorted(
+        (backend() for backend in botetmpars.EXTRACTION_BACKENDS.values()),
+        key=lambda backend: backend.name != 'soup',
+    )
+    all_equal = True
+
+    print(f"{'страница':<16} {'движок':<12} {'товаров':>8} {'мс/стр.':>10}")
+    for filename, source_name in FIXTURES.items():
+        with open(os.path.join(FIXTURES_DIR, filename), encoding='utf-8') as f:
+            html = f.read()
+        config = botetmpars.SOURCES[source_name]
+
+        reference = None
+        for backend in backends:
+            products = comparable(monitor.extract_products(html, config, backend))
+
+            started = time.perf_counter()
+            for _ in range(repeat):
+                monitor.extract_products(html, config, backend)
+            elapsed_ms = (time.perf_counter() - started) * 1000 / repeat
+
+            if reference is None:
+                reference = products
+                status = ""
+            elif products == reference:
+                status = "ok"
+            else:
+                status = "РАСХОЖДЕНИЕ"
+                all_equal = False
+
+            print(f"{filename:<16} {backend.name:<12} {len(products):>8} {elapsed_ms:>10.2f} {status}")
+
+    return all_equal
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк движков разбора HTML")
+    parser.add_argument("--repeat", type=int, default=20, help="число повторов на страницу")
+    args = parser.parse_args()
+
+    logging.getLogger("botetmpars").setLevel(logging.WARNING)
+    if not run(args.repeat):
+        print("❌ Движки вернули разные товары")
+        sys.exit(1)
+    print("✅ Все движки вернули одинаковые товары")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""Сквозной замер команды /check на локальном магазине-заглушке.
+
+Запуск из корня репозитория:
+    python bench/bench_pipeline.py [--scenario catalog] [--save-baseline]
+
+Скрипт запускает bench/fake_shop.py, направляет источники DNS-Shop и Citilink
+на него и для каждого сценария измеряет:
+    • время /check с холодным кэшем, из кэша снимков и с перепроверкой (ETag/304);
+    • число товаров и скорость обработки (товаров в секунду);
+    • пиковую память Python при холодной проверке (tracemalloc);
+    • точность - совпадение найденных товаров с ожидаемыми.
+
+Лимиты вежливости (скорость запросов к хосту, паузы между повторами) ослаблены
+через переменные окружения: они намеренно замедляют опрос и здесь только мешают.
+
+Код выхода 1 - если точность ниже 100% или, при наличии bench/baseline.json,
+время или память хуже сохраненных значений больше чем на --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import gc
+import asyncio
+import logging
+import argparse
+import functools
+import shutil
+import dataclasses
+import subprocess
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(ROOT, "bench")
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+# Каталог с базами замеров; удаляется в main()
+WORK_DIR = tempfile.mkdtemp(prefix="bench_pipeline_")
+
+# Модуль бота читает настройки при импорте
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("PRICES_DB", os.path.join(WORK_DIR, "prices.db"))
+os.environ.setdefault("HTTP_CACHE_DB", os.path.join(WORK_DIR, "http_cache.db"))
+os.environ.setdefault("FETCH_RATE", "200")
+os.environ.setdefault("FETCH_BURST", "50")
+os.environ.setdefault("FETCH_BACKOFF_BASE", "0.05")
+os.environ.setdefault("SNAPSHOT_TTL", "300")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+import botetmpars  # noqa: E402
+import fake_shop  # noqa: E402
+
+# Сценарий -> параметры страниц для DNS-Shop и Citilink.
+# Источники ходят на разные имена хоста, чтобы лимиты и размыкатели были раздельными, как в работе.
+SCENARIOS = {
+    "recorded": {
+        "DNS-Shop": "/fixture/dns_shop.html",
+        "Citilink": "/fixture/citilink.html",
+    },
+    "catalog": {
+        "DNS-Shop": "/catalog/dns?pages=40&per_page=40",
+        "Citilink": "/catalog/citilink?pages=25&per_page=40",
+    },
+    "slow": {
+        "DNS-Shop": "/catalog/dns?pages=5&per_page=40&delay=0.2",
+        "Citilink": "/catalog/citilink?pages=5&per_page=40&delay=0.2",
+    },
+    "errors": {
+        "DNS-Shop": "/catalog/dns?pages=5&per_page=40&error=429&fail_first=1",
+        "Citilink": "/catalog/citilink?pages=5&per_page=40&error=503&fail_first=1",
+    },
+}
+HOSTS = {"DNS-Shop": "127.0.0.1", "Citilink": "localhost"}
+
+# Метрики из baseline.json: имя -> True, если больше - лучше
+TRACKED = {"cold_s": False, "revalidate_s": False, "products_per_s": True, "peak_mb": False}
+# Разброс между запусками на малых сценариях: меньшее ухудшение не считается регрессией
+ABSOLUTE_SLACK = {"cold_s": 0.05, "revalidate_s": 0.05, "products_per_s": 0, "peak_mb": 2.0}
+
+class Reply:
+    """Заглушка Update/Context для вызова обработчика команды без Telegram"""
+
+    def __init__(self):
+        self.message = self
+        self.effective_chat = self
+        self.bot = self
+        self.id = 0
+        self.args = []
+        self.texts = []
+
+    async def reply_text(self, text, **kwargs):
+        self.texts.append(text)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.texts.append(text)
+
+def start_fake_shop():
+    """Запуск магазина-заглушки в отдельном процессе; возвращает процесс и порт"""
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_shop.py"), "--port", "0"],
+        stdout=subprocess.PIPE, text=True,
+    )
+    line = process.stdout.readline()
+    if not line.startswith("PORT "):
+        process.kill()
+        raise RuntimeError("магазин-заглушка не запустился")
+    return process, int(line.split()[1])
+
+def source_configs(scenario, port, run=0):
+    """Описания источников, направленные на магазин-заглушку.
+    
+    Номер прогона добавляется к адресу: магазин считает запросы к каждому адресу,
+    и ошибки fail_first должны повторяться в каждом прогоне.
+    """
+    configs = []
+    for name, path in SCENARIOS[scenario].items():
+        base_url = f"http://{HOSTS[name]}:{port}"
+        params = dict(part.split("=", 1) for part in path.partition("?")[2].split("&") if part)
+        separator = "&" if "?" in path else "?"
+        configs.append(dataclasses.replace(
+            botetmpars.SOURCES[name],
+            base_url=base_url,
+            category_url=f"{base_url}{path}{separator}run={run}",
+            # Одна лишняя страница: магазин повторяет последнюю, обход должен остановиться сам
+            max_pages=int(params.get("pages", 1)) + 1,
+        ))
+    return configs
+
+def expected_products(configs):
+    """Ожидаемые товары: по генератору для синтетики, по эталонному движку для фикстур"""
+    expected = set()
+    soup = botetmpars.EXTRACTION_BACKENDS["soup"]()
+    for config in configs:
+        path, _, query = config.category_url.partition(config.base_url)[2].partition("?")
+        if path.startswith("/fixture/"):
+            with open(os.path.join(FIXTURES_DIR, os.path.basename(path)), encoding="utf-8") as f:
+                records, _ = botetmpars.extract_records(f.read(), config, soup)
+            expected.update((config.name, product_id, name, price) for product_id, name, price, _ in records)
+        else:
+            params = dict(part.split("=", 1) for part in query.split("&") if part)
+            template = path.rstrip("/").rsplit("/", 1)[1]
+            for page in range(1, int(params["pages"]) + 1):
+                expected.update(
+                    (config.name, product_id, name, price)
+                    for product_id, name, price in fake_shop.catalog_items(template, page, int(params["per_page"]))
+                )
+    return expected
+
+def install_pipeline(configs):
+    """Свежие PriceMonitor и оркестратор с пустыми базами вместо глобальных объектов бота"""
+    run_dir = tempfile.mkdtemp(dir=WORK_DIR)
+    monitor = botetmpars.PriceMonitor()
+    monitor.store = botetmpars.PriceStore(os.path.join(run_dir, "prices.db"))
+    monitor.price_index = botetmpars.PriceIndex(monitor.store)
+    monitor.response_cache = botetmpars.ResponseCache(os.path.join(run_dir, "http_cache.db"))
+
+    orchestrator = botetmpars.SourceOrchestrator()
+    for config in configs:
+        orchestrator.register(config.name, functools.partial(monitor.parse_source, config))
+
+    botetmpars.price_monitor = monitor
+    botetmpars.orchestrator = orchestrator
+    return monitor
+
+async def timed_check(reply):
+    """Время выполнения обработчика /check"""
+    started = time.perf_counter()
+    await botetmpars.check_prices(reply, reply)
+    return time.perf_counter() - started
+
+async def measure(scenario, port):
+    """Замер одного сценария"""
+    configs = source_configs(scenario, port)
+    expected = expected_products(configs)
+
+    # Холодная проверка, ответ из кэша снимков и принудительная перепроверка через ETag
+    monitor = install_pipeline(configs)
+    reply = Reply()
+    cold = await timed_check(reply)
+    found = {(p.source, p.id, p.name, p.price) for p in monitor.snapshot}
+    cached = await timed_check(reply)
+    started = time.perf_counter()
+    await botetmpars.run_price_check(force=True)
+    revalidate = time.perf_counter() - started
+    await monitor.close()
+
+    # Память - отдельным холодным прогоном, tracemalloc искажает время
+    monitor = install_pipeline(source_configs(scenario, port, run=1))
+    gc.collect()
+    tracemalloc.start()
+    await timed_check(Reply())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await monitor.close()
+
+    accuracy = len(found & expected) / len(found | expected) if found | expected else 1.0
+    return {
+        "products": len(found),
+        "cold_s": cold,
+        "cached_s": cached,
+        "revalidate_s": revalidate,
+        "products_per_s": len(found) / cold if cold else 0.0,
+        "peak_mb": peak / 2 ** 20,
+        "accuracy": accuracy,
+    }
+
+def regressions(scenario, result, baseline, tolerance):
+    """Список ухудшений относительно сохраненных значений"""
+    problems = []
+    if result["accuracy"] < 1.0:
+        problems.append(f"{scenario}: точность {result['accuracy']:.1%}")
+    for key, higher_is_better in TRACKED.items():
+        reference = baseline.get(scenario, {}).get(key)
+        if not reference:
+            continue
+        slack = ABSOLUTE_SLACK[key]
+        if higher_is_better and result[key] < reference / (1 + tolerance) - slack:
+            problems.append(f"{scenario}: {key} {result[key]:.3g} < {reference:.3g}")
+        if not higher_is_better and result[key] > reference * (1 + tolerance) + slack:
+            problems.append(f"{scenario}: {key} {result[key]:.3g} > {reference:.3g}")
+    return problems
+
+async def run(scenarios, port):
+    print(f"{'сценарий':<10} {'товаров':>8} {'холодный, с':>12} {'из кэша, мс':>12} "
+          f"{'ETag, с':>8} {'тов./с':>8} {'память, МБ':>11} {'точность':>9}")
+    # Прогон вхолостую: загрузка лениво импортируемых модулей (httpx, парсер HTML) не входит в замеры
+    await measure("recorded", port)
+    results = {}
+    for scenario in scenarios:
+        result = results[scenario] = await measure(scenario, port)
+        print(f"{scenario:<10} {result['products']:>8} {result['cold_s']:>12.3f} "
+              f"{result['cached_s'] * 1000:>12.2f} {result['revalidate_s']:>8.3f} "
+              f"{result['products_per_s']:>8.0f} {result['peak_mb']:>11.1f} {result['accuracy']:>9.1%}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк /check на магазине-заглушке")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="по умолчанию - все")
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="сохранить результаты как эталон")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="допустимое ухудшение (0.5 - на 50%%)")
+    args = parser.parse_args()
+
+    logging.getLogger("botetmpars").setLevel(logging.ERROR)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    process, port = start_fake_shop()
+    try:
+        results = asyncio.run(run(args.scenario or list(SCENARIOS), port))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 Эталон сохранен: {args.baseline}")
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    problems = [
+        problem for scenario, result in results.items()
+        for problem in regressions(scenario, result, baseline, args.tolerance)
+    ]
+    if problems:
+        print("❌ Обнаружены ухудшения:")
+        for problem in problems:
+            print(f"   • {problem}")
+        sys.exit(1)
+    print("✅ Ухудшений не обнаружено")
+
+if __name__ == "__main__":
+    main()
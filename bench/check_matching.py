@@ -0,0 +1,95 @@
+"""Проверка сопоставления товаров между магазинами на сохраненных страницах каталогов.
+
+Запуск из корня репозитория:
+    python bench/check_matching.py
+
+Товары со всех фикстур собираются в один индекс сопоставления. Выводятся группы,
+объединившие предложения разных магазинов, и проверяется, что одна модель с по-разному
+записанными названиями попала в одну группу, а заведомо разные товары с общим
+артикулом - в разные. При ошибке в любую сторону скрипт завершается с кодом 1.
+"""
+import os
+import sys
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT, "bench", "fixtures")
+
+# Модуль бота требует токен при импорте; для проверки подойдет любой
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+sys.path.insert(0, ROOT)
+
+import botetmpars  # noqa: E402
+
+# Фикстура -> источник, чьи селекторы к ней применяются
+FIXTURES = {
+    "dns_shop.html": "DNS-Shop",
+    "citilink.html": "Citilink",
+}
+
+# Пары предложений одной модели в разных магазинах (названия записаны по-разному), которые нужно объединить
+SAME_PAIRS = [
+    ("Тепловентилятор керамический Timberk TFH T15PDS", "Тепловентилятор Timberk TFH T15PDS"),
+    ("Обогреватель конвекторный Ballu BEC/EZER-1500", "Конвектор Ballu BEC/EZER-1500"),
+    ("ИК-обогреватель Ballu BIH-AP4-1.0", "Инфракрасный обогреватель Ballu BIH-AP4-1.0"),
+]
+
+# Пары разных товаров (разные марки, общий артикул), которые нельзя объединять
+DISTINCT_PAIRS = [
+    ("Noirot EOH/M-3000E", "Zanussi EOH/M-3000E"),
+    ("Thermex EN-2500 Inverter", "Electrolux EN-2500"),
+]
+
+def load_products():
+    """Товары со всех фикстур"""
+    monitor = botetmpars.PriceMonitor()
+    products = []
+    for filename, source_name in FIXTURES.items():
+        with open(os.path.join(FIXTURES_DIR, filename), encoding='utf-8') as f:
+            html = f.read()
+        products.extend(monitor.extract_products(html, botetmpars.SOURCES[source_name]))
+    return products
+
+def groups_with(index, fragment):
+    """Номера групп товаров, в названии которых есть фрагмент"""
+    return {index.group_of[i] for i, product in enumerate(index.products) if fragment in product.name}
+
+def check_pair(index, first, second, same):
+    """Статус пары: ok или описание ошибки"""
+    first_groups, second_groups = groups_with(index, first), groups_with(index, second)
+    if not first_groups or not second_groups:
+        return "нет в фикстурах"
+    if same and first_groups != second_groups:
+        return "НЕ ОБЪЕДИНЕНЫ"
+    if not same and first_groups & second_groups:
+        return "ЛОЖНОЕ СОВПАДЕНИЕ"
+    return "ok"
+
+def run():
+    """Построение индекса и проверка пар; возвращает True, если все пары сопоставлены верно"""
+    index = botetmpars.MatchIndex(load_products())
+    ok = True
+
+    print(f"Товаров: {len(index)}, групп: {len(index.groups)}")
+    for members in index.groups:
+        offers = [index.products[i] for i in members]
+        if len({product.source for product in offers}) > 1:
+            print("  " + " | ".join(f"{product.source}: {product.name} ({product.price:.0f})" for product in offers))
+
+    for pairs, same in ((SAME_PAIRS, True), (DISTINCT_PAIRS, False)):
+        for first, second in pairs:
+            status = check_pair(index, first, second, same)
+            ok = ok and status == "ok"
+            print(f"{first} / {second}: {status}")
+
+    return ok
+
+def main():
+    logging.getLogger("botetmpars").setLevel(logging.WARNING)
+    if not run():
+        print("❌ Товары сопоставлены неверно или не найдены")
+        sys.exit(1)
+    print("✅ Одинаковые товары объединены, разные - нет")
+
+if __name__ == "__main__":
+    main()
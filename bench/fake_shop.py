@@ -0,0 +1,169 @@
+"""Локальный магазин-заглушка для офлайн-замеров парсера.
+
+Запуск из корня репозитория:
+    python bench/fake_shop.py [--port 8081]
+
+Адреса:
+    /fixture/<файл>            сохраненная страница из bench/fixtures
+    /catalog/dns, /catalog/citilink
+                               синтетический каталог в разметке магазина
+
+Параметры синтетического каталога (номер страницы - параметр p, как у магазинов):
+    pages=20        число страниц; дальше отдается последняя, как на настоящих сайтах
+    per_page=40     товаров на странице
+    delay=0         задержка ответа в секундах
+    error=503       код ошибки для режимов ниже
+    fail_first=0    первые N запросов к каждой странице завершаются ошибкой
+    error_rate=0    доля случайных ошибок
+
+Все ответы с кодом 200 содержат ETag и поддерживают условные запросы (304).
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+KINDS = ['Конвектор', 'Масляный радиатор', 'Тепловентилятор', 'Инфракрасный обогреватель']
+BRANDS = ['Ballu', 'Electrolux', 'Timberk', 'Scoole', 'Zanussi', 'Hyundai', 'Polaris', 'Royal Clima']
+COLORS = ['белый', 'черный', 'серый', 'бежевый']
+
+PAGE_HEAD = (
+    '<!DOCTYPE html>\n<html lang="ru"><head><meta charset="utf-8"><title>Обогреватели</title></head>\n'
+    '<body><header><ul class="menu">{menu}</ul></header>\n<main class="catalog">\n'
+)
+MENU_ITEM = '<li class="menu__item"><a href="/catalog/{0}/">Раздел {0}</a></li>'
+PAGE_TAIL = '</main>\n<footer class="footer">© fake shop</footer></body></html>\n'
+
+CARD_TEMPLATES = {
+    'dns': (
+        '<div class="catalog-product" data-id="{id}">\n'
+        '  <a class="catalog-product__name" href="/product/{id}/"><span>{name}</span></a>\n'
+        '  <div class="catalog-product__buy"><div class="product-buy__price">{price} ₽</div></div>\n'
+        '</div>\n'
+    ),
+    'citilink': (
+        '<div class="ProductCard" data-product-id="{id}">\n'
+        '  <a class="ProductCard__link" href="/product/{id}/" title="{name}"></a>\n'
+        '  <div class="ProductCard__name"><a href="/product/{id}/">{name}</a></div>\n'
+        '  <div class="ProductCard__price"><span class="price">{price}</span> ₽</div>\n'
+        '</div>\n'
+    ),
+}
+
+def catalog_items(template, page, per_page):
+    """Товары страницы синтетического каталога: кортежи (id, название, цена)"""
+    rng = random.Random(f"{template}:{page}")
+    items = []
+    for i in range(per_page):
+        number = (page - 1) * per_page + i
+        product_id = f"dns-{number:06d}" if template == 'dns' else str(2000000 + number)
+        name = f"{rng.choice(KINDS)} {rng.choice(BRANDS)} HT-{1000 + number} {rng.choice(COLORS)}"
+        price = rng.randrange(990, 60000, 10)
+        # Каждый седьмой товар - цена с копейками
+        if number % 7 == 0:
+            price += 0.5
+        items.append((product_id, name, price))
+    return items
+
+def format_price(price):
+    """Цена в виде, как на сайте: 12&nbsp;990 или 1&nbsp;299,50"""
+    rubles = f"{int(price):,}".replace(',', '&nbsp;')
+    kopecks = round((price - int(price)) * 100)
+    return f"{rubles},{kopecks:02d}" if kopecks else rubles
+
+def render_catalog(template, page, per_page):
+    """HTML страницы синтетического каталога"""
+    cards = ''.join(
+        CARD_TEMPLATES[template].format(id=product_id, name=name, price=format_price(price))
+        for product_id, name, price in catalog_items(template, page, per_page)
+    )
+    menu = ''.join(MENU_ITEM.format(number) for number in range(150))
+    return PAGE_HEAD.format(menu=menu) + cards + PAGE_TAIL
+
+class FakeShopHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов магазина-заглушки"""
+
+    attempts = {}
+    attempts_lock = threading.Lock()
+    rng = random.Random(0)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        delay = float(params.get('delay', 0))
+        if delay:
+            time.sleep(delay)
+
+        error = int(params.get('error', 503))
+        with self.attempts_lock:
+            attempt = self.attempts[self.path] = self.attempts.get(self.path, 0) + 1
+            random_failure = self.rng.random() < float(params.get('error_rate', 0))
+        if attempt <= int(params.get('fail_first', 0)) or random_failure:
+            self.send_response(error)
+            if error == 429:
+                self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if url.path.startswith('/fixture/'):
+            filename = os.path.basename(url.path)
+            path = os.path.join(FIXTURES_DIR, filename)
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            with open(path, 'rb') as f:
+                body = f.read()
+        elif url.path.rstrip('/') in ('/catalog/dns', '/catalog/citilink'):
+            template = url.path.rstrip('/').rsplit('/', 1)[1]
+            pages = int(params.get('pages', 20))
+            page = min(max(int(params.get('p', 1)), 1), pages)
+            body = render_catalog(template, page, int(params.get('per_page', 40))).encode('utf-8')
+        else:
+            self.send_error(404)
+            return
+
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный магазин-заглушка")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="0 - любой свободный порт")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), FakeShopHandler)
+    server.daemon_threads = True
+    # Первая строка вывода - порт, ее читает bench_pipeline.py
+    print(f"PORT {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,41 @@
+from __future__ import annotations
+
 import os
 import logging
-import requests
 import json
 import asyncio
 import sys
 import random
+import re
 import time
-from datetime import datetime
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
-from bs4 import BeautifulSoup
-from starlette.applications import Starlette
-from starlette.routing import Route
-from starlette.requests import Request
-from starlette.responses import Response, PlainTextResponse
-import uvicorn
+import io
+import csv
+import gzip
+import hashlib
+import sqlite3
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from collections import deque
+from contextlib import contextmanager
+import importlib
+import importlib.util
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta
+
+# Отсчет этапов запуска ведется от начала загрузки модуля
+MODULE_STARTED_AT = time.perf_counter()
+
+# Тяжелые библиотеки (python-telegram-bot, httpx, парсеры HTML, uvicorn) загружаются
+# при первом использовании: порт открывается раньше, чем они понадобятся
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
+    from starlette.requests import Request
+    from starlette.responses import Response, PlainTextResponse
 
 # Настройка логгирования
 logging.basicConfig(
@@ -32,235 +53,1989 @@ if not TOKEN:
 # Настройки для Render
 PORT = int(os.environ.get("PORT", 8000))
 WEBHOOK_URL = os.environ.get("RENDER_EXTERNAL_URL", "") + "/webhook"
+# Сколько обновлений, пришедших до готовности бота, вебхук откладывает до конца запуска
+STARTUP_UPDATE_BUFFER = int(os.environ.get("STARTUP_UPDATE_BUFFER", 100))
 PRICES_FILE = "prices.json"
+PRICES_DB = os.environ.get("PRICES_DB", "prices.db")
 
-# Создаем приложение Telegram
-try:
-    application = Application.builder().token(TOKEN).build()
-    logger.info("✅ Приложение Telegram успешно создано")
-except Exception as e:
-    logger.error(f"❌ Ошибка при создании приложения: {e}")
-    sys.exit(1)
+# Порог изменения цены в процентах; PRICE_CHANGE_THRESHOLDS задает пороги для источников и категорий
+PRICE_CHANGE_THRESHOLD = float(os.environ.get("PRICE_CHANGE_THRESHOLD", 10))
+PRICE_CHANGE_THRESHOLDS = os.environ.get("PRICE_CHANGE_THRESHOLDS", "")
 
-class PriceMonitor:
-    """Мониторинг цен на обогревательные приборы с DNS-Shop"""
+# Фоновый мониторинг: интервал опроса в секундах (0 - выключен) и случайный сдвиг
+MONITOR_INTERVAL = float(os.environ.get("MONITOR_INTERVAL", 1800))
+MONITOR_JITTER = float(os.environ.get("MONITOR_JITTER", 120))
+
+# Предельный размер выгрузки: Telegram принимает от ботов документы до 50 МБ
+EXPORT_MAX_BYTES = int(os.environ.get("EXPORT_MAX_BYTES", 49 * 1024 * 1024))
+
+# Очередь тяжелых команд (/check, /monitor, /get_prices): размер и число обработчиков
+WORK_QUEUE_SIZE = int(os.environ.get("WORK_QUEUE_SIZE", 20))
+WORK_QUEUE_WORKERS = int(os.environ.get("WORK_QUEUE_WORKERS", 2))
+
+# Настройки сетевого слоя
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", 15))
+FETCH_MAX_CONNECTIONS = int(os.environ.get("FETCH_MAX_CONNECTIONS", 20))
+FETCH_PER_HOST_LIMIT = int(os.environ.get("FETCH_PER_HOST_LIMIT", 4))
+
+# Политика запросов: частота на хост, повторы с экспоненциальной паузой и размыкатель
+FETCH_RATE = float(os.environ.get("FETCH_RATE", 2))
+FETCH_BURST = int(os.environ.get("FETCH_BURST", 4))
+FETCH_RETRIES = int(os.environ.get("FETCH_RETRIES", 3))
+FETCH_BACKOFF_BASE = float(os.environ.get("FETCH_BACKOFF_BASE", 1))
+FETCH_BACKOFF_MAX = float(os.environ.get("FETCH_BACKOFF_MAX", 30))
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", 300))
+SOURCE_DEADLINE = float(os.environ.get("SOURCE_DEADLINE", 20))
+
+# Кэш ответов на диске для условных запросов (HTTP_CACHE_MAX_BYTES=0 - выключен)
+HTTP_CACHE_DB = os.environ.get("HTTP_CACHE_DB", "http_cache.db")
+HTTP_CACHE_MAX_BYTES = int(os.environ.get("HTTP_CACHE_MAX_BYTES", 20 * 1024 * 1024))
+
+# Кэш снимков: сколько секунд данные свежие и сколько еще их можно отдавать, пока идет обновление
+SNAPSHOT_TTL = float(os.environ.get("SNAPSHOT_TTL", 300))
+SNAPSHOT_STALE_TTL = float(os.environ.get("SNAPSHOT_STALE_TTL", 3600))
+
+# Настройки постраничного обхода каталога (CRAWL_MAX_PAGES=1 - только первая страница)
+CRAWL_MAX_PAGES = int(os.environ.get("CRAWL_MAX_PAGES", 20))
+CRAWL_PAGE_CONCURRENCY = int(os.environ.get("CRAWL_PAGE_CONCURRENCY", 3))
+
+# Движок разбора HTML: auto, selectolax, lxml или soup
+EXTRACTION_BACKEND = os.environ.get("EXTRACTION_BACKEND", "auto")
+
+# Число процессов для разбора больших каталогов; 0 - разбор в потоке основного процесса
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", 0))
+
+# Список опрашиваемых источников через запятую; пусто - все включенные в реестре
+ENABLED_SOURCES = [name.strip() for name in os.environ.get("ENABLED_SOURCES", "").split(",") if name.strip()]
+
+# Сопоставление товаров между магазинами: минимальная доля общих слов в названиях
+# и максимальный размер блока (слишком частые артикулы вроде IP24 не сравниваются)
+MATCH_MIN_SIMILARITY = float(os.environ.get("MATCH_MIN_SIMILARITY", 0.6))
+MATCH_MAX_BLOCK = int(os.environ.get("MATCH_MAX_BLOCK", 50))
+
+# ===== МЕТРИКИ =====
+def format_labels(labels):
+    """Метки в формате Prometheus: {source="DNS-Shop"}"""
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def format_value(value):
+    """Значение метрики: целые - без потери разрядов, дробные - с полной точностью"""
+    if isinstance(value, int):
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    """Счетчик с метками"""
+    kind = "counter"
     
-    def __init__(self):
-        self.session = requests.Session()
-        self.setup_headers()
-        self.base_url = "https://www.dns-shop.ru"
-        self.category_url = "https://www.dns-shop.ru/catalog/17a89fab16404e77/obogrevateli/"
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self._lock = threading.Lock()
     
-    def setup_headers(self):
-        """Настройка реалистичных заголовков"""
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-            'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-        })
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            return [
+                f"{self.name}{format_labels(key)} {format_value(value)}" for key, value in sorted(self.values.items())
+            ]
+
+class Gauge:
+    """Текущее значение, вычисляемое при каждом чтении метрик"""
+    kind = "gauge"
+    
+    def __init__(self, name, description, collect):
+        self.name = name
+        self.description = description
+        self.collect = collect
     
-    def parse_products_dns(self):
-        """Парсинг обогревателей с DNS-Shop"""
+    def samples(self):
+        return [f"{self.name}{format_labels(key)} {format_value(value)}" for key, value in self.collect()]
+
+class Histogram:
+    """Гистограмма длительностей с метками"""
+    kind = "histogram"
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.series = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Замер длительности блока"""
+        started = time.perf_counter()
         try:
-            logger.info("🔄 Начинаем парсинг цен с DNS-Shop...")
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total:.6f}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Набор метрик и их вывод в текстовом формате Prometheus"""
+    
+    def __init__(self):
+        self.metrics = []
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+FETCH_SECONDS = METRICS.register(Histogram("scraper_fetch_seconds", "Время загрузки страницы с учетом повторов"))
+FETCH_RESPONSES = METRICS.register(Counter("scraper_fetch_responses_total", "Ответы магазинов по кодам HTTP"))
+PARSE_SECONDS = METRICS.register(Histogram("scraper_parse_seconds", "Время построения дерева HTML"))
+EXTRACT_SECONDS = METRICS.register(Histogram("scraper_extract_seconds", "Время извлечения товаров из карточек"))
+CARDS_FOUND = METRICS.register(Counter("scraper_cards_found_total", "Найдено карточек товаров"))
+CARDS_ACCEPTED = METRICS.register(Counter("scraper_cards_accepted_total", "Карточек, из которых извлечен товар"))
+INCOMPLETE_CRAWLS = METRICS.register(Counter(
+    "scraper_incomplete_crawls_total", "Обходов источника, прерванных ошибкой страницы или лимитом времени"
+))
+PERSIST_SECONDS = METRICS.register(Histogram("scraper_persist_seconds", "Время записи в хранилища"))
+TELEGRAM_SECONDS = METRICS.register(Histogram("telegram_request_seconds", "Время запросов к Telegram Bot API"))
+COMMANDS_REJECTED = METRICS.register(Counter("work_queue_rejected_commands_total", "Команд, отклоненных при перегрузке"))
+
+def source_failure_samples():
+    """Число неудачных опросов подряд по источникам"""
+    return [((('source', name),), health['failures']) for name, health in sorted(orchestrator.health.items())]
+
+METRICS.register(Gauge("scraper_source_consecutive_failures", "Неудачных опросов источника подряд", source_failure_samples))
+METRICS.register(Gauge("work_queue_depth", "Команд в очереди", lambda: [((), work_queue.depth)]))
+METRICS.register(Gauge(
+    "startup_stage_seconds", "Время от начала загрузки до этапа запуска",
+    lambda: [((('stage', stage),), seconds) for stage, seconds in startup.stages.items()]
+))
+
+# Приложение Telegram создается в main() после открытия порта
+application = None
+
+def create_application():
+    """Сборка приложения Telegram с замером времени каждого вызова Bot API"""
+    from telegram.ext import Application
+    from telegram.request import HTTPXRequest
+    
+    class TimedTelegramRequest(HTTPXRequest):
+        """HTTP-клиент Telegram с замером времени каждого вызова Bot API"""
+        
+        async def do_request(self, url, method, *args, **kwargs):
+            with TELEGRAM_SECONDS.time(method=url.rsplit('/', 1)[-1]):
+                return await super().do_request(url, method, *args, **kwargs)
+    
+    return (
+        Application.builder()
+        .token(TOKEN)
+        .request(TimedTelegramRequest(connection_pool_size=256))
+        .build()
+    )
+
+# Наборы заголовков браузеров; при блокировке хоста переключаемся на следующий
+HEADER_PROFILES = [
+    {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+        'Sec-Ch-Ua': '"Not_A Brand";v="8", "Chromium";v="120", "Google Chrome";v="120"',
+        'Sec-Ch-Ua-Platform': '"Windows"',
+    },
+    {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15',
+        'Accept-Language': 'ru-RU,ru;q=0.9',
+    },
+    {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
+        'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
+    },
+    {
+        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36 Edg/119.0.0.0',
+        'Accept-Language': 'ru,en;q=0.9',
+        'Sec-Ch-Ua': '"Microsoft Edge";v="119", "Chromium";v="119", "Not?A_Brand";v="24"',
+        'Sec-Ch-Ua-Platform': '"Linux"',
+    },
+]
+
+# Ответы, после которых запрос стоит повторить с паузой
+RETRY_STATUSES = {403, 429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    """Хост временно исключен из опроса после серии неудач"""
+
+class PageFetchError(Exception):
+    """Страница каталога не загрузилась: обход источника неполный"""
+
+class TokenBucket:
+    """Адаптивное ограничение частоты запросов к хосту: при 429/403 скорость падает вдвое и затем плавно растет"""
+    
+    def __init__(self, rate=FETCH_RATE, burst=FETCH_BURST, min_rate=0.05):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = None
+    
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def slow_down(self):
+        """Снижение скорости после сигнала о перегрузке"""
+        self.rate = max(self.min_rate, self.rate / 2)
+    
+    def speed_up(self):
+        """Постепенное восстановление скорости после успешных ответов"""
+        self.rate = min(self.base_rate, self.rate + self.base_rate * 0.1)
+
+class CircuitBreaker:
+    """Размыкатель: после серии неудач подряд хост пропускается на время паузы.
+    
+    После паузы размыкатель полуоткрыт: пропускается один пробный запрос, остальные
+    отклоняются, пока проба не завершится. Успех замыкает размыкатель, неудача
+    размыкает снова на полную паузу.
+    """
+    
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+    
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+    
+    def allow(self):
+        """Можно ли обращаться к хосту; в полуоткрытом состоянии разрешение получает только проба"""
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        # Проба, не вернувшая результат за время паузы (например, отмененная), считается потерянной
+        if self.probe_started_at is not None and now - self.probe_started_at < self.cooldown:
+            return False
+        self.probe_started_at = now
+        return True
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        # Неудачная проба размыкает сразу, без набора порога заново
+        if self.failures >= self.threshold or self.probe_started_at is not None:
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+
+class AsyncFetcher:
+    """Асинхронная загрузка страниц через общий пул соединений с политикой повторов и ограничений"""
+    
+    def __init__(self, timeout=FETCH_TIMEOUT, max_connections=FETCH_MAX_CONNECTIONS,
+                 per_host_limit=FETCH_PER_HOST_LIMIT, retries=FETCH_RETRIES,
+                 backoff_base=FETCH_BACKOFF_BASE, backoff_max=FETCH_BACKOFF_MAX):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.headers = {}
+        self._client = None
+        self._host_semaphores = {}
+        self._buckets = {}
+        self._breakers = {}
+        self._profiles = {}
+    
+    @property
+    def client(self):
+        """Общий httpx-клиент, создается при первом обращении"""
+        if self._client is None or self._client.is_closed:
+            import httpx
+            self._client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+    
+    def _host_semaphore(self, url):
+        """Семафор, ограничивающий число одновременных запросов к одному хосту"""
+        host = urlsplit(url).hostname
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host_limit)
+            self._host_semaphores[host] = semaphore
+        return semaphore
+    
+    def _bucket(self, host):
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket()
+        return self._buckets[host]
+    
+    def _breaker(self, host):
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker()
+        return self._breakers[host]
+    
+    def _profile_headers(self, host):
+        """Текущий набор заголовков браузера для хоста"""
+        return HEADER_PROFILES[self._profiles.get(host, 0) % len(HEADER_PROFILES)]
+    
+    def _rotate_profile(self, host):
+        """Переход к следующему набору заголовков после блокировки"""
+        self._profiles[host] = self._profiles.get(host, 0) + 1
+    
+    def _retry_delay(self, attempt, response):
+        """Пауза перед повтором: Retry-After от сервера или экспоненциальная со случайным разбросом"""
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+    
+    async def get(self, url, headers=None, **kwargs):
+        """GET-запрос с лимитами на хост, повторами при 429/5xx и таймаутах и размыкателем"""
+        import httpx
+        host = urlsplit(url).hostname
+        breaker = self._breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError(f"{host} временно исключен после {breaker.failures} неудач подряд")
+        
+        bucket = self._bucket(host)
+        response = None
+        error = None
+        
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self._retry_delay(attempt - 1, response))
             
-            response = self.session.get(self.category_url, timeout=15)
+            await bucket.acquire()
+            request_headers = dict(self._profile_headers(host), **(headers or {}))
+            try:
+                async with self._host_semaphore(url):
+                    response = await self.client.get(url, headers=request_headers, **kwargs)
+            except httpx.TransportError as e:
+                # Таймауты и сетевые ошибки
+                response, error = None, e
+                logger.warning(f"⚠️ {host}: {type(e).__name__}, попытка {attempt + 1}")
+                continue
             
-            if response.status_code != 200:
-                logger.error(f"❌ Ошибка HTTP: {response.status_code}")
-                return []
+            if response.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                bucket.speed_up()
+                return response
+            
+            logger.warning(f"⚠️ {host}: HTTP {response.status_code}, попытка {attempt + 1}")
+            if response.status_code in (403, 429):
+                bucket.slow_down()
+                self._rotate_profile(host)
+        
+        breaker.record_failure()
+        if breaker.is_open:
+            logger.error(f"🔌 {host}: размыкатель сработал, пауза {breaker.cooldown:g} с")
+        
+        if response is not None:
+            return response
+        raise error
+    
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+@dataclass
+class CachedResponse:
+    """Запись кэша ответов: валидаторы HTTP и результат разбора страницы"""
+    etag: str
+    last_modified: str
+    content_hash: str
+    records: list
+    
+    def conditional_headers(self):
+        """Заголовки условного запроса"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+class ResponseCache:
+    """Кэш ответов на диске (SQLite): ETag/Last-Modified, хэш содержимого и товары, вытеснение по LRU"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            etag TEXT NOT NULL DEFAULT '',
+            last_modified TEXT NOT NULL DEFAULT '',
+            content_hash TEXT NOT NULL,
+            products TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at);
+    """
+    
+    def __init__(self, path=HTTP_CACHE_DB, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._connection = None
+        self._lock = threading.RLock()
+    
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+    
+    @property
+    def connection(self):
+        """Соединение с базой кэша; схема создается при первом обращении"""
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.executescript(self.SCHEMA)
+            return self._connection
+    
+    def lookup(self, url, fingerprint):
+        """Запись для URL или None; записи, сделанные другими селекторами, не используются"""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT etag, last_modified, content_hash, products FROM responses "
+                "WHERE url = ? AND fingerprint = ?", (url, fingerprint)
+            ).fetchone()
+        if row is None:
+            return None
+        return CachedResponse(row[0], row[1], row[2], json.loads(row[3]))
+    
+    def touch(self, url, etag='', last_modified=''):
+        """Отметка обращения (для LRU) и обновление валидаторов"""
+        with self._lock:
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE responses SET accessed_at = ?, "
+                    "etag = COALESCE(NULLIF(?, ''), etag), "
+                    "last_modified = COALESCE(NULLIF(?, ''), last_modified) WHERE url = ?",
+                    (time.time(), etag, last_modified, url)
+                )
+    
+    def store(self, url, fingerprint, etag, last_modified, content_hash, products):
+        """Сохранение результата разбора страницы с вытеснением старых записей.
+        
+        Товары хранятся компактно, списками [id, название, цена, ссылка]: источник
+        задан отпечатком, а время опроса при чтении из кэша все равно обновляется.
+        """
+        records = [[product.id, product.name, product.price, product.link] for product in products]
+        payload = json.dumps(records, ensure_ascii=False, separators=(',', ':'))
+        size = len(payload.encode('utf-8'))
+        with self._lock, PERSIST_SECONDS.time(target="response_cache"):
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(url, fingerprint, etag, last_modified, content_hash, products, size, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (url, fingerprint, etag, last_modified, content_hash, payload, size, time.time())
+                )
+                self._evict()
+    
+    def _evict(self):
+        """Удаление давно не использованных записей сверх лимита размера"""
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        evicted = 0
+        for url, size in self.connection.execute(
+            "SELECT url, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM responses WHERE url = ?", (url,))
+            total -= size
+            evicted += 1
+        
+        logger.info(f"🧹 Кэш ответов: вытеснено записей: {evicted}")
+    
+    def close(self):
+        """Закрытие соединения с базой кэша"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+# ===== ИСТОЧНИКИ ЦЕН =====
+@dataclass(frozen=True)
+class SourceConfig:
+    """Декларативное описание магазина: адреса, CSS-селекторы и лимиты обхода"""
+    name: str
+    base_url: str
+    category_url: str
+    card_selector: str
+    name_selector: str
+    price_selector: str
+    link_selector: str = 'a'
+    id_attribute: str = ''
+    category: str = 'obogrevateli'
+    page_param: str = 'p'
+    max_pages: int = CRAWL_MAX_PAGES
+    icon: str = '🔵'
+    enabled: bool = True
+
+# Реестр источников: имя -> описание
+SOURCES = {}
+
+def register_source(config):
+    """Добавление источника в реестр"""
+    SOURCES[config.name] = config
+    return config
+
+def enabled_sources():
+    """Источники, которые нужно опрашивать (ENABLED_SOURCES переопределяет флаг enabled)"""
+    if ENABLED_SOURCES:
+        return [SOURCES[name] for name in ENABLED_SOURCES if name in SOURCES]
+    return [config for config in SOURCES.values() if config.enabled]
+
+def source_icon(name):
+    """Значок источника для сообщений"""
+    config = SOURCES.get(name)
+    return config.icon if config else '🔵'
+
+@functools.lru_cache(maxsize=None)
+def source_fingerprint(config):
+    """Отпечаток описания источника: при смене селекторов кэш разбора становится недействительным"""
+    # Префикс - версия формата записей в кэше ответов
+    return hashlib.sha1(f"records-v2:{config!r}".encode('utf-8')).hexdigest()[:16]
+
+@functools.lru_cache(maxsize=None)
+def compile_selector(selector):
+    """CSS-селектор компилируется один раз и переиспользуется для всех карточек"""
+    import soupsieve
+    return soupsieve.compile(selector)
+
+register_source(SourceConfig(
+    name='DNS-Shop',
+    base_url='https://www.dns-shop.ru',
+    category_url='https://www.dns-shop.ru/catalog/17a89fab16404e77/obogrevateli/',
+    card_selector='.catalog-product, .product-card, [data-id]',
+    name_selector='.catalog-product__name, .product-title, .title',
+    price_selector='.product-buy__price, .price, .cost',
+    id_attribute='data-id',
+    icon='🛒',
+))
+
+register_source(SourceConfig(
+    name='Citilink',
+    base_url='https://www.citilink.ru',
+    category_url='https://www.citilink.ru/catalog/obogrevateli/',
+    card_selector='.ProductCard, .product_data, [data-product-id]',
+    name_selector='.ProductCard__name, .title',
+    price_selector='.ProductCard__price, .price',
+    id_attribute='data-product-id',
+))
+
+# etm.ru блокирует запросы с Render, поэтому источник выключен по умолчанию
+register_source(SourceConfig(
+    name='ETM',
+    base_url='https://www.etm.ru',
+    category_url=os.environ.get("ETM_CATEGORY_URL", "https://www.etm.ru/catalog/"),
+    card_selector='.catalog-item, [data-product-id]',
+    name_selector='.catalog-item__name, .title',
+    price_selector='.catalog-item__price, .price',
+    id_attribute='data-product-id',
+    icon='⚡',
+    enabled=False,
+))
+
+# ===== ДВИЖКИ РАЗБОРА HTML =====
+@functools.lru_cache(maxsize=None)
+def compile_lxml_selector(selector):
+    """CSS-селектор для lxml, скомпилированный в XPath (только потомки узла)"""
+    from lxml import etree as lxml_etree
+    from cssselect import HTMLTranslator
+    return lxml_etree.XPath(HTMLTranslator().css_to_xpath(selector, prefix='descendant::'))
+
+class SoupBackend:
+    """Разбор через BeautifulSoup + html.parser (чистый Python, запасной вариант)"""
+    name = 'soup'
+    
+    def parse(self, html):
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(html, 'html.parser')
+    
+    def select(self, node, selector):
+        return compile_selector(selector).select(node)
+    
+    def select_one(self, node, selector):
+        return compile_selector(selector).select_one(node)
+    
+    def text(self, node):
+        return node.get_text(strip=True)
+    
+    def attr(self, node, name):
+        return node.get(name) or ''
+
+class LxmlBackend:
+    """Разбор через lxml (libxml2) с селекторами, скомпилированными в XPath"""
+    name = 'lxml'
+    
+    def parse(self, html):
+        import lxml.html as lxml_html
+        try:
+            return lxml_html.document_fromstring(html)
+        except ValueError:
+            # Строка с XML-объявлением кодировки разбирается только как байты
+            return lxml_html.document_fromstring(
+                html.encode('utf-8'), parser=lxml_html.HTMLParser(encoding='utf-8')
+            )
+    
+    def select(self, node, selector):
+        return compile_lxml_selector(selector)(node)
+    
+    def select_one(self, node, selector):
+        found = compile_lxml_selector(selector)(node)
+        return found[0] if found else None
+    
+    def text(self, node):
+        return ''.join(part.strip() for part in node.itertext())
+    
+    def attr(self, node, name):
+        return node.get(name) or ''
+
+class SelectolaxBackend:
+    """Разбор через selectolax (lexbor) - самый быстрый вариант, если пакет установлен"""
+    name = 'selectolax'
+    
+    def parse(self, html):
+        from selectolax.lexbor import LexborHTMLParser
+        return LexborHTMLParser(html)
+    
+    def select(self, node, selector):
+        # lexbor включает в выборку сам узел и может повторять совпадения
+        own_id = getattr(node, 'mem_id', None)
+        seen = set()
+        found = []
+        for match in node.css(selector):
+            if match.mem_id != own_id and match.mem_id not in seen:
+                seen.add(match.mem_id)
+                found.append(match)
+        return found
+    
+    def select_one(self, node, selector):
+        own_id = getattr(node, 'mem_id', None)
+        for match in node.css(selector):
+            if match.mem_id != own_id:
+                return match
+        return None
+    
+    def text(self, node):
+        return node.text(deep=True, separator='', strip=True)
+    
+    def attr(self, node, name):
+        return node.attributes.get(name) or ''
+
+def module_available(name):
+    """Установлен ли модуль; сам модуль при этом не загружается"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:
+        return False
+
+# Движки в порядке предпочтения: первый доступный используется по умолчанию
+EXTRACTION_BACKENDS = {}
+if module_available('selectolax.lexbor'):
+    EXTRACTION_BACKENDS['selectolax'] = SelectolaxBackend
+if module_available('lxml.html') and module_available('cssselect'):
+    EXTRACTION_BACKENDS['lxml'] = LxmlBackend
+EXTRACTION_BACKENDS['soup'] = SoupBackend
+
+def get_extraction_backend(name=None):
+    """Движок разбора по имени; 'auto' или неизвестное имя - самый быстрый из доступных"""
+    name = name or EXTRACTION_BACKEND
+    if name not in EXTRACTION_BACKENDS:
+        if name != 'auto':
+            logger.warning(f"⚠️ Движок разбора {name} недоступен, использую автоматический выбор")
+        name = next(iter(EXTRACTION_BACKENDS))
+    return EXTRACTION_BACKENDS[name]()
+
+@dataclass
+class Product:
+    """Товар из каталога; __slots__ вместо словаря заметно экономят память на больших каталогах"""
+    __slots__ = ('id', 'name', 'price', 'link', 'source', 'last_updated')
+    id: str
+    name: str
+    price: float
+    link: str
+    source: str
+    last_updated: str
+
+# Первое число в тексте цены: разряды через пробел (в том числе неразрывный),
+# точку или запятую, копейки - одна-две цифры после точки или запятой
+PRICE_PATTERN = re.compile(r'(?P<rubles>\d{1,3}(?:[\s.,]\d{3})+|\d+)(?:[.,](?P<kopecks>\d{1,2}))?(?!\d)')
+NON_DIGITS = re.compile(r'\D')
+
+def clean_price(price_text):
+    """Цена из текста: '1 299,50 ₽' -> 1299.5, 'от 1 990 до 2 490' -> 1990; 0 - если цены нет"""
+    match = PRICE_PATTERN.search(price_text)
+    if match is None:
+        return 0
+    rubles = NON_DIGITS.sub('', match.group('rubles'))
+    kopecks = match.group('kopecks')
+    return float(f"{rubles}.{kopecks}") if kopecks else float(rubles)
+
+def generate_product_id(product_name):
+    """Стабильный ID товара по названию (формат совпадает с уже накопленной историей)"""
+    return hashlib.md5(product_name.encode('utf-8')).hexdigest()[:10]
+
+def extract_records(html, config, backend):
+    """Извлечение товаров из HTML в виде кортежей (id, название, цена, ссылка).
+    
+    Вторым значением возвращается статистика разбора: число карточек, время
+    построения дерева и время извлечения. Метрики по ней пишет вызывающая
+    сторона, поэтому функция одинаково работает в потоке и в дочернем процессе.
+    """
+    started = time.perf_counter()
+    document = backend.parse(html)
+    parsed = time.perf_counter()
+    
+    product_cards = backend.select(document, config.card_selector)
+    records = []
+    
+    for card in product_cards:
+        try:
+            # Название товара
+            name_elem = backend.select_one(card, config.name_selector)
+            if name_elem is None:
+                continue
             
-            soup = BeautifulSoup(response.text, 'html.parser')
-            products = []
+            product_name = backend.text(name_elem)
             
-            # Ищем карточки товаров на DNS-Shop
-            product_cards = soup.select('.catalog-product, .product-card, [data-id]')
+            # Цена товара
+            price_elem = backend.select_one(card, config.price_selector)
+            if price_elem is None:
+                continue
             
-            logger.info(f"📦 Найдено карточек товаров: {len(product_cards)}")
+            price = clean_price(backend.text(price_elem))
             
-            for card in product_cards[:15]:  # Ограничиваем количество
-                try:
-                    # Название товара
-                    name_elem = card.select_one('.catalog-product__name, .product-title, .title')
-                    if not name_elem:
-                        continue
-                    
-                    product_name = name_elem.get_text(strip=True)
-                    
-                    # Цена товара
-                    price_elem = card.select_one('.product-buy__price, .price, .cost')
-                    if not price_elem:
-                        continue
-                    
-                    price_text = price_elem.get_text(strip=True)
-                    price = self.clean_price(price_text)
-                    
-                    if price <= 0:
-                        continue
-                    
-                    # Ссылка на товар
-                    link_elem = card.find('a')
-                    product_link = link_elem.get('href') if link_elem else ''
-                    if product_link and not product_link.startswith('http'):
-                        product_link = self.base_url + product_link
-                    
-                    # ID товара
-                    product_id = card.get('data-id') or self.generate_product_id(product_name)
-                    
-                    products.append({
-                        'id': product_id,
-                        'name': product_name[:100],
-                        'price': price,
-                        'link': product_link,
-                        'source': 'DNS-Shop',
-                        'last_updated': datetime.now().isoformat()
-                    })
-                        
-                except Exception as e:
-                    logger.warning(f"⚠️ Ошибка при обработке карточки: {e}")
-                    continue
+            if price <= 0:
+                continue
             
-            logger.info(f"✅ Успешно обработано товаров: {len(products)}")
-            return products
+            # Ссылка на товар
+            link_elem = backend.select_one(card, config.link_selector) if config.link_selector else None
+            product_link = backend.attr(link_elem, 'href') if link_elem is not None else ''
+            if product_link and not product_link.startswith('http'):
+                product_link = config.base_url + product_link
+            
+            # ID товара
+            product_id = (
+                (config.id_attribute and backend.attr(card, config.id_attribute))
+                or generate_product_id(product_name)
+            )
             
+            records.append((product_id, product_name[:100], price, product_link))
+                
         except Exception as e:
-            logger.error(f"❌ Ошибка при парсинге DNS-Shop: {e}")
+            logger.warning(f"⚠️ Ошибка при обработке карточки {config.name}: {e}")
+            continue
+    
+    return records, (len(product_cards), parsed - started, time.perf_counter() - parsed)
+
+# Движок разбора в дочернем процессе создается один раз на процесс
+_worker_backends = {}
+
+def extract_records_in_worker(content, encoding, config, backend_name):
+    """Разбор страницы в процессе пула: на вход сырые байты, на выход компактные кортежи"""
+    backend = _worker_backends.get(backend_name)
+    if backend is None:
+        backend = _worker_backends[backend_name] = get_extraction_backend(backend_name)
+    html = content.decode(encoding or 'utf-8', errors='replace')
+    return extract_records(html, config, backend)
+
+# ===== ХРАНИЛИЩЕ ЦЕН =====
+class PriceStore:
+    """История цен в SQLite: строка на каждое новое значение цены (товар, источник, время)"""
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS price_history (
+            product_id TEXT NOT NULL,
+            source TEXT NOT NULL,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            link TEXT NOT NULL DEFAULT '',
+            scraped_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_price_history_product
+            ON price_history (source, product_id, scraped_at);
+        CREATE INDEX IF NOT EXISTS idx_price_history_time
+            ON price_history (scraped_at);
+        CREATE TABLE IF NOT EXISTS subscribers (
+            chat_id INTEGER PRIMARY KEY,
+            subscribed_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS scrapes (
+            source TEXT PRIMARY KEY,
+            scraped_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS listed_products (
+            source TEXT NOT NULL,
+            product_id TEXT NOT NULL,
+            PRIMARY KEY (source, product_id)
+        );
+    """
+    
+    def __init__(self, path=PRICES_DB):
+        self.path = path
+        self._connection = None
+        # Соединение используется из потоков asyncio.to_thread, поэтому доступ под блокировкой
+        self._lock = threading.RLock()
+    
+    @property
+    def connection(self):
+        """Соединение с базой; схема создается при первом обращении"""
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.path, check_same_thread=False)
+                self._connection.row_factory = sqlite3.Row
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.executescript(self.SCHEMA)
+                self._import_legacy_json()
+            return self._connection
+    
+    def _import_legacy_json(self):
+        """Однократный перенос цен из старого prices.json в пустую базу"""
+        if not os.path.exists(PRICES_FILE):
+            return
+        if self._connection.execute("SELECT 1 FROM price_history LIMIT 1").fetchone():
+            return
+        try:
+            with open(PRICES_FILE, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            rows = [
+                (product_id, item.get('source', 'Unknown'), item['name'], item['price'],
+                 item.get('link') or '', item['last_updated'])
+                for product_id, item in legacy.items()
+            ]
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO price_history (product_id, source, name, price, link, scraped_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+            logger.info(f"📥 Перенесено цен из {PRICES_FILE}: {len(rows)}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка при переносе {PRICES_FILE}: {e}")
+    
+    def append_prices(self, products):
+        """Пакетная запись новых значений цен одной транзакцией"""
+        rows = [
+            (product.id, product.source, product.name, product.price, product.link, product.last_updated)
+            for product in products
+        ]
+        if not rows:
+            return 0
+        with self._lock:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO price_history (product_id, source, name, price, link, scraped_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+        return len(rows)
+    
+    def latest_prices(self, source=None):
+        """Последняя цена каждого товара: список Product"""
+        query = (
+            "SELECT product_id, source, name, price, link, scraped_at, MAX(rowid) "
+            "FROM price_history {where} GROUP BY source, product_id"
+        )
+        params = ()
+        if source:
+            query, params = query.format(where="WHERE source = ?"), (source,)
+        else:
+            query = query.format(where="")
+        
+        with self._lock:
+            rows = self.connection.execute(query, params).fetchall()
+        
+        return [
+            Product(row['product_id'], row['name'], row['price'], row['link'], row['source'], row['scraped_at'])
+            for row in rows
+        ]
+    
+    def current_prices(self):
+        """Последняя цена товаров, найденных при последнем полном обходе своего источника: список Product"""
+        query = (
+            "SELECT h.product_id, h.source, h.name, h.price, h.link, h.scraped_at FROM ("
+            "SELECT product_id, source, name, price, link, scraped_at, MAX(rowid) "
+            "FROM price_history GROUP BY source, product_id) h "
+            "JOIN listed_products l ON l.source = h.source AND l.product_id = h.product_id"
+        )
+        with self._lock:
+            rows = self.connection.execute(query).fetchall()
+        
+        return [
+            Product(row['product_id'], row['name'], row['price'], row['link'], row['source'], row['scraped_at'])
+            for row in rows
+        ]
+    
+    def iter_prices(self, source=None, since=None, batch_size=1000):
+        """Строки для выгрузки порциями: история с момента since или последние цены.
+        
+        Читает через отдельное соединение, чтобы долгая выгрузка не блокировала запись новых цен.
+        """
+        conditions, params = [], []
+        if source:
+            conditions.append("source = ?")
+            params.append(source)
+        if since:
+            conditions.append("scraped_at >= ?")
+            params.append(since.isoformat())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        if since:
+            query = (
+                "SELECT product_id, source, name, price, link, scraped_at "
+                f"FROM price_history {where} ORDER BY scraped_at"
+            )
+        else:
+            query = (
+                "SELECT product_id, source, name, price, link, scraped_at FROM ("
+                "SELECT product_id, source, name, price, link, scraped_at, MAX(rowid) "
+                f"FROM price_history {where} GROUP BY source, product_id)"
+            )
+        
+        # Схема должна существовать до открытия отдельного соединения
+        self.connection
+        reader = sqlite3.connect(self.path)
+        try:
+            cursor = reader.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            reader.close()
+    
+    def price_history(self, source, product_id, since=None):
+        """История цены товара: пары (время, цена) по возрастанию времени"""
+        query = (
+            "SELECT scraped_at, price FROM price_history "
+            "WHERE source = ? AND product_id = ? AND scraped_at >= ? ORDER BY scraped_at"
+        )
+        since_text = since.isoformat() if since else ''
+        with self._lock:
+            rows = self.connection.execute(query, (source, product_id, since_text)).fetchall()
+        return [(row['scraped_at'], row['price']) for row in rows]
+    
+    def listed_products(self):
+        """Словарь источник -> ID товаров, найденных при последнем полном обходе"""
+        with self._lock:
+            rows = self.connection.execute("SELECT source, product_id FROM listed_products").fetchall()
+        listed = {}
+        for row in rows:
+            listed.setdefault(row['source'], set()).add(row['product_id'])
+        return listed
+    
+    def update_listing(self, source, appeared, vanished, scraped_at):
+        """Полный обход источника: изменения состава каталога и время опроса одной транзакцией.
+        
+        История хранит только изменения цен, поэтому снятые с продажи товары отличаются по составу каталога.
+        """
+        with self._lock:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO listed_products (source, product_id) VALUES (?, ?)",
+                    ((source, product_id) for product_id in appeared)
+                )
+                self.connection.executemany(
+                    "DELETE FROM listed_products WHERE source = ? AND product_id = ?",
+                    ((source, product_id) for product_id in vanished)
+                )
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO scrapes (source, scraped_at) VALUES (?, ?)", (source, scraped_at)
+                )
+    
+    def last_scrapes(self):
+        """Словарь источник -> время последнего опроса"""
+        with self._lock:
+            rows = self.connection.execute("SELECT source, scraped_at FROM scrapes").fetchall()
+        return {row['source']: row['scraped_at'] for row in rows}
+    
+    def add_subscriber(self, chat_id):
+        """Подписка чата; False - если чат уже подписан"""
+        with self._lock:
+            with self.connection:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO subscribers (chat_id, subscribed_at) VALUES (?, ?)",
+                    (chat_id, datetime.now().isoformat())
+                )
+        return cursor.rowcount > 0
+    
+    def remove_subscriber(self, chat_id):
+        """Отписка чата; False - если чат не был подписан"""
+        with self._lock:
+            with self.connection:
+                cursor = self.connection.execute("DELETE FROM subscribers WHERE chat_id = ?", (chat_id,))
+        return cursor.rowcount > 0
+    
+    def subscribers(self):
+        """Идентификаторы подписанных чатов"""
+        with self._lock:
+            rows = self.connection.execute("SELECT chat_id FROM subscribers").fetchall()
+        return [row['chat_id'] for row in rows]
+    
+    def close(self):
+        """Закрытие соединения с базой"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+def parse_thresholds(text):
+    """Разбор порогов вида "DNS-Shop=5,obogrevateli=8" в словарь"""
+    thresholds = {}
+    for item in text.split(","):
+        key, _, value = item.partition("=")
+        if key.strip() and value.strip():
+            try:
+                thresholds[key.strip()] = float(value)
+            except ValueError:
+                logger.warning(f"⚠️ Некорректный порог изменения цены: {item}")
+    return thresholds
+
+class PriceIndex:
+    """Индекс последних цен в памяти: загружается из хранилища один раз и обновляется после каждого опроса"""
+    
+    def __init__(self, store, thresholds=None, default_threshold=PRICE_CHANGE_THRESHOLD):
+        self.store = store
+        self.thresholds = parse_thresholds(PRICE_CHANGE_THRESHOLDS) if thresholds is None else thresholds
+        self.default_threshold = default_threshold
+        self._last_prices = None
+        self._listed = None
+        self._lock = threading.RLock()
+    
+    @property
+    def last_prices(self):
+        """Словарь (источник, ID) -> последняя цена"""
+        with self._lock:
+            if self._last_prices is None:
+                self._last_prices = {
+                    (product.source, product.id): product.price
+                    for product in self.store.latest_prices()
+                }
+                logger.info(f"📇 Загружен индекс цен: {len(self._last_prices)} товаров")
+            return self._last_prices
+    
+    @property
+    def listed(self):
+        """Словарь источник -> ID товаров в каталоге при последнем полном обходе"""
+        with self._lock:
+            if self._listed is None:
+                self._listed = self.store.listed_products()
+            return self._listed
+    
+    def threshold_for(self, source):
+        """Порог изменения в процентах: для источника, затем для категории, затем общий"""
+        if source in self.thresholds:
+            return self.thresholds[source]
+        config = SOURCES.get(source)
+        if config and config.category in self.thresholds:
+            return self.thresholds[config.category]
+        return self.default_threshold
+    
+    def detect(self, products):
+        """Изменения цен относительно индекса; индекс и хранилище не меняются"""
+        changes = []
+        seen = set()
+        
+        with self._lock:
+            last_prices = self.last_prices
+            for product in products:
+                source = product.source
+                key = (source, product.id)
+                if key in seen:
+                    continue
+                seen.add(key)
+                
+                previous_price = last_prices.get(key)
+                if not previous_price or previous_price <= 0:
+                    continue
+                
+                current_price = product.price
+                change_percent = ((current_price - previous_price) / previous_price) * 100
+                
+                if abs(change_percent) >= self.threshold_for(source):
+                    changes.append({
+                        'id': product.id,
+                        'name': product.name,
+                        'previous_price': previous_price,
+                        'current_price': current_price,
+                        'change_percent': change_percent,
+                        'link': product.link,
+                        'source': source
+                    })
+        
+        return changes
+    
+    def commit(self, products, complete_sources=()):
+        """Запись в хранилище только новых и изменившихся цен с обновлением индекса.
+        
+        Для источников из complete_sources (обход завершен полностью) записываются и изменения
+        состава каталога: появившиеся и пропавшие товары; неполный обход состав не меняет.
+        """
+        with self._lock:
+            last_prices = self.last_prices
+            changed = []
+            current = {}
+            scraped_at = {}
+            for product in products:
+                source = product.source
+                key = (source, product.id)
+                if last_prices.get(key) != product.price:
+                    last_prices[key] = product.price
+                    changed.append(product)
+                if source in complete_sources:
+                    current.setdefault(source, set()).add(product.id)
+                    if product.last_updated > scraped_at.get(source, ''):
+                        scraped_at[source] = product.last_updated
+            
+            try:
+                with PERSIST_SECONDS.time(target="price_history"):
+                    self.store.append_prices(changed)
+                    listed = self.listed
+                    for source, ids in current.items():
+                        previous = listed.get(source, set())
+                        self.store.update_listing(source, ids - previous, previous - ids, scraped_at[source])
+                        listed[source] = ids
+            except Exception:
+                # Индекс должен совпадать с базой: при ошибке перечитаем его при следующем обращении
+                self._last_prices = None
+                self._listed = None
+                raise
+        
+        return len(changed)
+    
+    def detect_and_commit(self, products, complete_sources=()):
+        """Атомарно: найти изменения до записи, затем сохранить новые цены"""
+        with self._lock:
+            changes = self.detect(products)
+            self.commit(products, complete_sources)
+        return changes
+
+# ===== СОПОСТАВЛЕНИЕ ТОВАРОВ =====
+# Разделители внутри артикула: BEC/EVU-2000 -> becevu2000
+MODEL_SEPARATORS = re.compile(r'(?<=[^\W_])[-/.](?=[^\W_])')
+TITLE_DELIMITERS = re.compile(r'[\W_]+')
+# Слова с цифрами, которые описывают характеристики, а не модель: 2000вт, 1.5квт, 20м2
+UNIT_TOKEN = re.compile(r'\d+(?:вт|квт|w|kw|м2|м|мм|см|л|шт|ч|в|v)')
+# Вид товара и цвет: общие для разных моделей слова не должны делать их похожими
+GENERIC_WORDS = frozenset({
+    'обогреватель', 'икобогреватель', 'инфракрасный', 'кварцевый', 'масляный', 'радиатор',
+    'конвектор', 'конвекторный', 'тепловентилятор', 'керамический', 'тепловая', 'пушка',
+    'электрический', 'электрическая', 'настенный', 'напольный',
+    'белый', 'черный', 'серый', 'серебристый', 'бежевый', 'красный', 'синий', 'коричневый',
+})
+# Известные марки обогревателей: первое слово марки после нормализации (royal clima -> royal)
+BRANDS = frozenset({
+    'aeg', 'almac', 'atlantic', 'ballu', 'bork', 'delonghi', 'dimplex', 'electrolux', 'engy',
+    'hyundai', 'neoclima', 'noirot', 'oasis', 'polaris', 'resanta', 'royal', 'scarlett', 'scoole',
+    'sonnen', 'stadler', 'tesy', 'thermex', 'timberk', 'vitek', 'xiaomi', 'zanussi',
+    'ресанта', 'теплэко',
+})
+
+def title_tokens(title):
+    """Нормализованные слова названия: нижний регистр, ё -> е, артикулы без разделителей"""
+    title = MODEL_SEPARATORS.sub('', title.lower().replace('ё', 'е'))
+    return [token for token in TITLE_DELIMITERS.split(title) if token]
+
+def is_model_token(token):
+    """Похоже ли слово на артикул: есть и буквы, и цифры, и это не единица измерения"""
+    return (
+        any(c.isdigit() for c in token)
+        and any(c.isalpha() for c in token)
+        and not UNIT_TOKEN.fullmatch(token)
+    )
+
+def significant_tokens(tokens):
+    """Слова, отличающие модели друг от друга: без вида товара, цвета и единиц измерения"""
+    return {token for token in tokens if token not in GENERIC_WORDS and not UNIT_TOKEN.fullmatch(token)}
+
+def brand_token(tokens):
+    """Марка из списка известных; None, если в названии ее нет"""
+    for token in tokens:
+        if token in BRANDS:
+            return token
+    return None
+
+def trigrams(token):
+    """Символьные триграммы слова"""
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+class MatchIndex:
+    """Индекс одинаковых товаров в разных магазинах и поиск по названию.
+    
+    Товары группируются по артикулу: кандидатами считаются только товары с общим
+    артикулом (блокировка), и лишь внутри блока сравниваются значимые слова названий.
+    Товары разных известных марок не объединяются даже при совпадающем артикуле.
+    Для поиска хранится инвертированный индекс символьных триграмм.
+    """
+    
+    def __init__(self, products=(), min_similarity=MATCH_MIN_SIMILARITY, max_block=MATCH_MAX_BLOCK):
+        self.products = list(products)
+        self.min_similarity = min_similarity
+        self.max_block = max_block
+        self.titles = []
+        self.groups = []
+        self.group_of = []
+        self.postings = {}
+        self.build()
+    
+    def __len__(self):
+        return len(self.products)
+    
+    def build(self):
+        """Построение групп и поискового индекса"""
+        tokens = [title_tokens(product.name) for product in self.products]
+        token_sets = [set(product_tokens) for product_tokens in tokens]
+        self.titles = [' '.join(product_tokens) for product_tokens in tokens]
+        significant = [significant_tokens(product_tokens) for product_tokens in tokens]
+        brands = [brand_token(product_tokens) for product_tokens in tokens]
+        
+        # Блоки: артикул -> товары, где он встречается
+        blocks = {}
+        for i, product_tokens in enumerate(token_sets):
+            for token in product_tokens:
+                if is_model_token(token):
+                    blocks.setdefault(token, []).append(i)
+        
+        parent = list(range(len(self.products)))
+        
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        
+        for members in blocks.values():
+            if len(members) < 2 or len(members) > self.max_block:
+                continue
+            for position, i in enumerate(members):
+                for j in members[position + 1:]:
+                    if find(i) == find(j):
+                        continue
+                    if brands[i] and brands[j] and brands[i] != brands[j]:
+                        continue
+                    if self.similarity(significant[i], significant[j]) >= self.min_similarity:
+                        parent[find(j)] = find(i)
+        
+        groups = {}
+        for i in range(len(self.products)):
+            groups.setdefault(find(i), []).append(i)
+        # Предложения внутри группы - по возрастанию цены
+        self.groups = [sorted(members, key=lambda i: self.products[i].price) for members in groups.values()]
+        self.group_of = [0] * len(self.products)
+        for group_number, members in enumerate(self.groups):
+            for i in members:
+                self.group_of[i] = group_number
+        
+        self.postings = {}
+        for i, product_tokens in enumerate(token_sets):
+            for token in product_tokens:
+                for gram in trigrams(token) or {token}:
+                    self.postings.setdefault(gram, set()).add(i)
+    
+    @staticmethod
+    def similarity(first, second):
+        """Доля общих слов относительно более короткого названия"""
+        if not first or not second:
+            return 0
+        return len(first & second) / min(len(first), len(second))
+    
+    def candidates(self, token):
+        """Товары, в названии которых встречается слово запроса (в том числе как часть слова)"""
+        grams = trigrams(token) or {token}
+        found = None
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if not posting:
+                return set()
+            found = set(posting) if found is None else found & posting
+        if len(token) < 3:
+            return {i for i in found if token in self.titles[i].split()}
+        return {i for i in found if token in self.titles[i]}
+    
+    def search(self, query, limit=5):
+        """Группы товаров по запросу: списки предложений от дешевого к дорогому, дешевые группы первыми"""
+        query_tokens = title_tokens(query)
+        if not query_tokens:
             return []
+        
+        matched = None
+        for token in query_tokens:
+            found = self.candidates(token)
+            matched = found if matched is None else matched & found
+            if not matched:
+                return []
+        
+        group_numbers = {self.group_of[i] for i in matched}
+        offers = [[self.products[i] for i in self.groups[number]] for number in group_numbers]
+        offers.sort(key=lambda group: group[0].price)
+        return offers[:limit]
+
+# ===== ПАРСИНГ ИСТОЧНИКОВ =====
+class PriceMonitor:
+    """Мониторинг цен на обогревательные приборы по зарегистрированным источникам"""
+    
+    def __init__(self):
+        self.fetcher = AsyncFetcher()
+        self.response_cache = ResponseCache()
+        self.store = PriceStore()
+        self.price_index = PriceIndex(self.store)
+        # Последний полный снимок цен для мгновенных ответов
+        self.snapshot = []
+        self.snapshot_time = None
+        # Снимки источников из кэша, по которым построен снимок: повторный ответ из кэша не обрабатывается заново
+        self.snapshot_entries = ()
+        # Индекс сопоставления перестраивается вместе со снимком
+        self.match_index = MatchIndex()
+        self.backend = get_extraction_backend()
+        # Пул процессов для разбора создается при первой странице, если PARSE_WORKERS > 0
+        self.parse_workers = PARSE_WORKERS
+        self.parse_pool = None
+        self.setup_headers()
+        logger.info(f"✅ Движок разбора HTML: {self.backend.name}")
+    
+    def setup_headers(self):
+        """Настройка реалистичных заголовков (User-Agent и язык берутся из HEADER_PROFILES)"""
+        self.fetcher.headers.update({
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+            # br httpx распаковывает только при установленном пакете brotli
+            'Accept-Encoding': 'gzip, deflate, br' if module_available('brotli') else 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+    
+    async def close(self):
+        """Освобождение сетевых ресурсов и хранилища"""
+        await self.fetcher.close()
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown(wait=False, cancel_futures=True)
+            self.parse_pool = None
+        self.response_cache.close()
+        self.store.close()
+    
+    def get_parse_pool(self):
+        """Пул процессов для разбора HTML (None - разбор в потоке)"""
+        if self.parse_workers <= 0:
+            return None
+        if self.parse_pool is None:
+            # spawn вместо fork: основной процесс держит потоки и соединения SQLite
+            self.parse_pool = ProcessPoolExecutor(
+                max_workers=self.parse_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            logger.info(f"✅ Разбор HTML в пуле из {self.parse_workers} процессов")
+        return self.parse_pool
+    
+    async def extract_page(self, response, config):
+        """Разбор загруженной страницы в пуле процессов или в отдельном потоке"""
+        pool = self.get_parse_pool()
+        if pool is None:
+            return await asyncio.to_thread(self.extract_products, response.text, config)
+        
+        loop = asyncio.get_running_loop()
+        records, stats = await loop.run_in_executor(
+            pool, extract_records_in_worker,
+            response.content, response.encoding, config, self.backend.name,
+        )
+        return self.build_products(records, config, stats)
+    
+    @staticmethod
+    def page_url(url, page, page_param='p'):
+        """URL страницы каталога с заданным номером"""
+        if page <= 1:
+            return url
+        import httpx
+        return str(httpx.URL(url).copy_merge_params({page_param: page}))
     
-    def parse_products_citilink(self):
-        """Парсинг обогревателей с Citilink (альтернатива)"""
+    @staticmethod
+    def to_products(records, config):
+        """Товары из кортежей (id, название, цена, ссылка) с единым временем опроса на всю страницу"""
+        scraped_at = datetime.now().isoformat()
+        source = config.name
+        return [Product(product_id, name, price, link, source, scraped_at) for product_id, name, price, link in records]
+    
+    async def fetch_page(self, url, config):
+        """Загрузка и разбор одной страницы; [] - конец каталога (404/410), None - если страница недоступна"""
         try:
-            logger.info("🔄 Пробуем Citilink...")
+            cache = self.response_cache
+            fingerprint = source_fingerprint(config)
+            cached = await asyncio.to_thread(cache.lookup, url, fingerprint) if cache.enabled else None
             
-            url = "https://www.citilink.ru/catalog/obogrevateli/"
-            response = self.session.get(url, timeout=15)
+            headers = cached.conditional_headers() if cached else {}
+            try:
+                with FETCH_SECONDS.time(source=config.name):
+                    response = await self.fetcher.get(url, headers=headers)
+            except Exception:
+                FETCH_RESPONSES.inc(source=config.name, status="error")
+                raise
+            FETCH_RESPONSES.inc(source=config.name, status=response.status_code)
             
-            if response.status_code != 200:
+            # Страница не изменилась - разбор не нужен
+            if response.status_code == 304 and cached:
+                await asyncio.to_thread(cache.touch, url)
+                return self.to_products(cached.records, config)
+            
+            # Несуществующая страница за концом каталога - не ошибка
+            if response.status_code in (404, 410):
                 return []
             
-            soup = BeautifulSoup(response.text, 'html.parser')
-            products = []
+            if response.status_code != 200:
+                logger.error(f"❌ Ошибка HTTP {response.status_code}: {url}")
+                return None
+            
+            etag = response.headers.get('ETag', '')
+            last_modified = response.headers.get('Last-Modified', '')
+            content_hash = hashlib.sha1(response.content).hexdigest()
             
-            product_cards = soup.select('.ProductCard, .product_data, [data-product-id]')
+            if cached and cached.content_hash == content_hash:
+                await asyncio.to_thread(cache.touch, url, etag, last_modified)
+                return self.to_products(cached.records, config)
             
-            for card in product_cards[:10]:
-                try:
-                    name_elem = card.select_one('.ProductCard__name, .title')
-                    price_elem = card.select_one('.ProductCard__price, .price')
-                    
-                    if name_elem and price_elem:
-                        product_name = name_elem.get_text(strip=True)
-                        price = self.clean_price(price_elem.get_text(strip=True))
-                        
-                        if price > 0:
-                            products.append({
-                                'id': self.generate_product_id(product_name),
-                                'name': product_name[:100],
-                                'price': price,
-                                'link': '',
-                                'source': 'Citilink',
-                                'last_updated': datetime.now().isoformat()
-                            })
-                except Exception:
-                    continue
+            # Разбор HTML выполняем вне цикла событий, чтобы не блокировать бота и вебхук
+            products = await self.extract_page(response, config)
             
+            if cache.enabled:
+                await asyncio.to_thread(
+                    cache.store, url, fingerprint, etag, last_modified, content_hash, products
+                )
             return products
             
         except Exception as e:
-            logger.error(f"❌ Ошибка при парсинге Citilink: {e}")
-            return []
+            logger.error(f"❌ Ошибка при загрузке {url}: {e}")
+            return None
+    
+    async def crawl_pages(self, config, concurrency=CRAWL_PAGE_CONCURRENCY):
+        """Постраничный обход категории: отдает товары страница за страницей"""
+        previous_ids = None
+        page = 1
+        
+        while page <= config.max_pages:
+            # Загружаем окно из нескольких страниц параллельно
+            pages = range(page, min(page + concurrency, config.max_pages + 1))
+            results = await asyncio.gather(*(
+                self.fetch_page(self.page_url(config.category_url, number, config.page_param), config)
+                for number in pages
+            ))
+            
+            for number, products in zip(pages, results):
+                # None - ошибка загрузки, а не конец каталога: без исключения часть товаров молча пропала бы
+                if products is None:
+                    raise PageFetchError(f"страница {number} не загружена, обход прерван")
+                if not products:
+                    return
+                
+                # Магазины часто отдают последнюю страницу вместо несуществующей
+                page_ids = {product.id for product in products}
+                if page_ids == previous_ids:
+                    return
+                previous_ids = page_ids
+                
+                yield products
+            
+            page += len(pages)
     
-    def clean_price(self, price_text):
-        """Очистка и преобразование цены в число"""
+    async def parse_source(self, config):
+        """Парсинг одного источника: товары отдаются постранично"""
+        logger.info(f"🔄 Начинаем парсинг цен с {config.name}...")
+        
+        total = 0
+        async for products in self.crawl_pages(config):
+            total += len(products)
+            yield products
+        
+        logger.info(f"✅ {config.name}: успешно обработано товаров: {total}")
+    
+    def extract_products(self, html, config, backend=None):
+        """Извлечение товаров из HTML-страницы по описанию источника"""
+        records, stats = extract_records(html, config, backend or self.backend)
+        return self.build_products(records, config, stats)
+    
+    def build_products(self, records, config, stats):
+        """Товары из кортежей разбора с единым временем опроса; запись метрик разбора"""
+        cards_found, parse_seconds, extract_seconds = stats
+        PARSE_SECONDS.observe(parse_seconds, source=config.name)
+        EXTRACT_SECONDS.observe(extract_seconds, source=config.name)
+        CARDS_FOUND.inc(cards_found, source=config.name)
+        CARDS_ACCEPTED.inc(len(records), source=config.name)
+        logger.info(f"📦 {config.name}: найдено карточек товаров: {cards_found}")
+        return self.to_products(records, config)
+    
+    def update_snapshot(self, products, fetched_at=None, entries=()):
+        """Замена снимка текущих цен и перестроение индекса сопоставления"""
+        match_index = MatchIndex(products)
+        self.snapshot = products
+        self.snapshot_time = fetched_at or datetime.now()
+        self.snapshot_entries = tuple(entries)
+        self.match_index = match_index
+    
+    def is_current(self, entries):
+        """Снимок уже построен из этих же записей кэша (сравнение по объектам, не по содержимому)"""
+        return len(entries) == len(self.snapshot_entries) and all(
+            entry is current for entry, current in zip(entries, self.snapshot_entries)
+        )
+    
+    def monitor_changes(self, current_products, complete_sources=()):
+        """Поиск изменений до сохранения и последующая запись новых цен"""
         try:
-            # Удаляем все символы кроме цифр
-            cleaned = ''.join(c for c in price_text if c.isdigit())
-            return float(cleaned) if cleaned else 0
-        except:
-            return 0
+            changes = self.price_index.detect_and_commit(current_products, complete_sources)
+            logger.info(f"💾 Проверено цен: {len(current_products)}, изменений: {len(changes)}")
+            return changes
+        except Exception as e:
+            logger.error(f"❌ Ошибка при сохранении цен: {e}")
+            return []
+
+@dataclass
+class CacheEntry:
+    """Снимок товаров одного источника; complete=False - обход прерван и снимок неполный"""
+    products: list
+    fetched_at: datetime
+    loaded_at: float
+    complete: bool = True
+
+class SnapshotCache:
+    """Кэш снимков по источникам: TTL, отдача устаревших данных во время обновления и один запрос на источник"""
     
-    def generate_product_id(self, product_name):
-        """Генерация ID товара"""
-        import hashlib
-        return hashlib.md5(product_name.encode()).hexdigest()[:10]
+    def __init__(self, ttl=SNAPSHOT_TTL, stale_ttl=SNAPSHOT_STALE_TTL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = {}
+        self._in_flight = {}
     
-    def load_previous_prices(self):
-        """Загрузка предыдущих цен из файла"""
+    def is_warm(self):
+        """Есть ли хотя бы один непустой снимок"""
+        return any(entry.products for entry in self.entries.values())
+    
+    def preload(self, name, products, fetched_at):
+        """Снимок из хранилища при запуске: возраст считается от времени опроса, а не загрузки"""
+        age = max((datetime.now() - fetched_at).total_seconds(), 0)
+        entry = self.entries[name] = CacheEntry(products, fetched_at, time.monotonic() - age)
+        return entry
+    
+    async def get(self, name, loader, force=False):
+        """Снимок источника; loader - корутинная функция, возвращающая товары и признак полного обхода"""
+        entry = self.entries.get(name)
+        if entry is not None and not force:
+            age = time.monotonic() - entry.loaded_at
+            # Неполный снимок отдается, но сразу обновляется; пустой неудачный - кэшируется как обычно
+            if age <= self.ttl and (entry.complete or not entry.products):
+                return entry
+            if age <= self.ttl + self.stale_ttl:
+                # Отдаем устаревший снимок сразу, обновление идет в фоне
+                self._refresh(name, loader)
+                return entry
+        
+        # shield: отмена одного ожидающего не прерывает общую загрузку
+        return await asyncio.shield(self._refresh(name, loader))
+    
+    def _refresh(self, name, loader):
+        """Общая задача загрузки источника: параллельные запросы ждут одну и ту же"""
+        task = self._in_flight.get(name)
+        if task is None:
+            task = asyncio.create_task(self._load(name, loader))
+            self._in_flight[name] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(name, None))
+        return task
+    
+    async def _load(self, name, loader):
+        """Загрузка снимка; при неудаче остается предыдущий"""
         try:
-            if os.path.exists(PRICES_FILE):
-                with open(PRICES_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {}
+            products, complete = await loader()
         except Exception as e:
-            logger.error(f"❌ Ошибка при загрузке предыдущих цен: {e}")
-            return {}
+            logger.error(f"❌ Ошибка обновления снимка {name}: {e}")
+            products, complete = [], False
+        
+        previous = self.entries.get(name)
+        if products or previous is None or not previous.products:
+            # Пустой результат тоже кэшируется, чтобы недоступный источник не опрашивался на каждый запрос
+            self.entries[name] = CacheEntry(products, datetime.now(), time.monotonic(), complete)
+        
+        return self.entries[name]
+
+class SourceOrchestrator:
+    """Одновременный опрос всех зарегистрированных источников"""
     
-    def save_current_prices(self, products):
-        """Сохранение текущих цен в файл"""
+    def __init__(self, deadline=SOURCE_DEADLINE):
+        self.deadline = deadline
+        self.sources = {}
+        self.cache = SnapshotCache()
+        # Состояние источников: неудачных опросов подряд и время последнего успеха
+        self.health = {}
+    
+    def register(self, name, crawl, deadline=None):
+        """Регистрация источника: crawl - асинхронный генератор, отдающий товары постранично"""
+        self.sources[name] = (crawl, deadline or self.deadline)
+    
+    async def _crawl(self, name, on_page):
+        """Обход источника с ограничением по времени; on_page вызывается для каждой страницы.
+        
+        Возвращает True, если обход дошел до конца каталога.
+        """
+        crawl, deadline = self.sources[name]
+        
+        async def drain():
+            async for products in crawl():
+                await on_page(products)
+        
         try:
-            prices_data = {}
-            for product in products:
-                prices_data[product['id']] = {
-                    'name': product['name'],
-                    'price': product['price'],
-                    'link': product['link'],
-                    'source': product.get('source', 'Unknown'),
-                    'last_updated': product['last_updated']
-                }
-            
-            with open(PRICES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(prices_data, f, ensure_ascii=False, indent=2)
-            
-            logger.info(f"💾 Сохранено цен для {len(prices_data)} товаров")
-            return prices_data
+            await asyncio.wait_for(drain(), timeout=deadline)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱ {name}: превышен лимит ожидания {deadline:g} с")
+            INCOMPLETE_CRAWLS.inc(source=name, reason="timeout")
         except Exception as e:
-            logger.error(f"❌ Ошибка при сохранении цен: {e}")
-            return {}
+            logger.error(f"❌ Ошибка источника {name}: {e}")
+            INCOMPLETE_CRAWLS.inc(source=name, reason="error")
+        return False
     
-    def check_price_changes(self, current_products):
-        """Проверка изменений цен на 10% и более"""
-        previous_prices = self.load_previous_prices()
-        changes = []
+    async def collect_source(self, name):
+        """Все товары одного источника и признак полного обхода.
         
-        for product in current_products:
-            product_id = product['id']
-            current_price = product['price']
-            
-            if product_id in previous_prices:
-                previous_price = previous_prices[product_id]['price']
-                
-                if previous_price > 0:
-                    change_percent = ((current_price - previous_price) / previous_price) * 100
-                    
-                    if abs(change_percent) >= 10:
-                        changes.append({
-                            'name': product['name'],
-                            'previous_price': previous_price,
-                            'current_price': current_price,
-                            'change_percent': change_percent,
-                            'link': product['link'],
-                            'source': product.get('source', 'Unknown')
-                        })
+        Список целиком нужен снимку и индексу сопоставления, поэтому страницы накапливаются;
+        при ошибке или превышении лимита времени возвращается то, что успели собрать.
+        """
+        collected = []
         
-        return changes
+        async def keep_page(products):
+            collected.extend(products)
+        
+        complete = await self._crawl(name, keep_page)
+        if collected and not complete:
+            logger.warning(f"⚠️ {name}: обход неполный, собрано товаров: {len(collected)}")
+        
+        health = self.health.setdefault(name, {'failures': 0, 'last_success': None})
+        if collected and complete:
+            health['failures'] = 0
+            health['last_success'] = datetime.now()
+        else:
+            health['failures'] += 1
+        return collected, complete
+    
+    def degraded(self):
+        """Ни один источник не был обойден полностью при последнем опросе"""
+        return bool(self.sources) and all(
+            self.health.get(name, {}).get('failures', 0) > 0 for name in self.sources
+        )
+    
+    async def collect(self, force=False):
+        """Сбор товаров со всех источников через кэш снимков; порядок - как при регистрации.
+        
+        Возвращает товары, время самого старого из использованных снимков и сами записи кэша.
+        """
+        entries = await asyncio.gather(*(
+            self.cache.get(name, functools.partial(self.collect_source, name), force=force)
+            for name in self.sources
+        ))
+        
+        for name, entry in zip(self.sources, entries):
+            if entry.products:
+                logger.info(f"✅ {name}: {len(entry.products)} товаров")
+        
+        fetched_at = min((entry.fetched_at for entry in entries if entry.products), default=None)
+        return [product for entry in entries for product in entry.products], fetched_at, entries
 
 # Создаем монитор цен
 price_monitor = PriceMonitor()
 
+# Регистрируем источники цен
+orchestrator = SourceOrchestrator()
+for source_config in enabled_sources():
+    orchestrator.register(source_config.name, functools.partial(price_monitor.parse_source, source_config))
+
+# ===== ФОНОВЫЙ МОНИТОРИНГ =====
+def format_age(fetched_at):
+    """Возраст данных в читаемом виде"""
+    seconds = (datetime.now() - fetched_at).total_seconds()
+    if seconds < 60:
+        return "только что"
+    if seconds < 3600:
+        return f"{seconds // 60:.0f} мин назад"
+    return f"{seconds // 3600:.0f} ч {seconds % 3600 // 60:.0f} мин назад"
+
+def escape_markdown(text):
+    """Экранирование служебных символов Markdown в тексте вне выделения (внутри *...* Telegram экранирование не принимает)"""
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+def format_products_message(products, snapshot_time=None):
+    """Сообщение со списком текущих цен"""
+    message = "📊 *Текущие цены на обогреватели:*\n\n"
+    
+    # Названия товаров и магазинов - текст магазина: экранируются и не попадают внутрь *...*
+    for i, product in enumerate(products[:8], 1):
+        message += f"{i}. {source_icon(product.source)} {escape_markdown(product.name)}\n"
+        message += f"   💰 *{product.price:.0f} руб.*\n"
+        if product.source:
+            message += f"   📍 {escape_markdown(product.source)}\n"
+        if product.link:
+            message += f"   🔗 [Ссылка]({product.link})\n"
+        message += "\n"
+    
+    message += f"Всего найдено товаров: {len(products)}"
+    if snapshot_time:
+        message += f"\n🕒 Данные обновлены {format_age(snapshot_time)}"
+    
+    return message
+
+def format_changes_message(changes):
+    """Сообщение об изменениях цен"""
+    message = "🚨 *Обнаружены изменения цен!*\n\n"
+    
+    # Названия - текст магазина: экранируются и не попадают внутрь *...*
+    for change in changes[:8]:
+        direction = "📈" if change['change_percent'] > 0 else "📉"
+        message += f"{direction} {source_icon(change.get('source'))} {escape_markdown(change['name'])}\n"
+        message += f"   Было: {change['previous_price']:.0f} руб.\n"
+        message += f"   Стало: {change['current_price']:.0f} руб.\n"
+        message += f"   Изменение: {change['change_percent']:+.1f}%\n"
+        if change.get('source'):
+            message += f"   📍 {escape_markdown(change['source'])}\n"
+        message += "\n"
+    
+    if len(changes) > 8:
+        message += f"... и еще {len(changes) - 8} изменений"
+    
+    return message
+
+async def notify_subscribers(bot, changes, skip_chat_id=None):
+    """Рассылка изменений цен подписанным чатам"""
+    from telegram.error import Forbidden
+    
+    chat_ids = await asyncio.to_thread(price_monitor.store.subscribers)
+    message = format_changes_message(changes)
+    
+    for chat_id in chat_ids:
+        if chat_id == skip_chat_id:
+            continue
+        try:
+            await bot.send_message(
+                chat_id=chat_id, text=message, parse_mode='Markdown', disable_web_page_preview=True
+            )
+        except Forbidden:
+            # Пользователь заблокировал бота - подписка больше не нужна
+            await asyncio.to_thread(price_monitor.store.remove_subscriber, chat_id)
+            logger.info(f"🔕 Чат {chat_id} недоступен, подписка удалена")
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки уведомления в чат {chat_id}: {e}")
+
+async def run_price_check(bot=None, skip_chat_id=None, force=False):
+    """Цикл проверки: получение цен (через кэш снимков), поиск изменений, запись цен и рассылка"""
+    products, fetched_at, entries = await orchestrator.collect(force=force)
+    if not products:
+        return [], []
+    
+    # Ответ целиком из уже обработанных снимков: цены записаны, индекс построен
+    if price_monitor.is_current(entries):
+        return products, []
+    
+    # Изменения определяются до записи новых цен; состав каталога меняют только полные обходы
+    complete_sources = {
+        name for name, entry in zip(orchestrator.sources, entries) if entry.complete and entry.products
+    }
+    changes = await asyncio.to_thread(price_monitor.monitor_changes, products, complete_sources)
+    await asyncio.to_thread(price_monitor.update_snapshot, products, fetched_at, entries)
+    
+    if changes and bot is not None:
+        await notify_subscribers(bot, changes, skip_chat_id=skip_chat_id)
+    
+    return products, changes
+
+async def preload_snapshot():
+    """Теплый снимок цен из хранилища, чтобы /check и /compare отвечали сразу после запуска"""
+    products = await asyncio.to_thread(price_monitor.store.current_prices)
+    if not products:
+        return 0
+    scrapes = await asyncio.to_thread(price_monitor.store.last_scrapes)
+    
+    by_source = {}
+    for product in products:
+        by_source.setdefault(product.source, []).append(product)
+    
+    snapshot = []
+    fetched = []
+    entries = []
+    for name in orchestrator.sources:
+        source_products = by_source.get(name)
+        if not source_products:
+            continue
+        fetched_at = datetime.fromisoformat(scrapes[name])
+        entries.append(orchestrator.cache.preload(name, source_products, fetched_at))
+        snapshot.extend(source_products)
+        fetched.append(fetched_at)
+    
+    if snapshot:
+        await asyncio.to_thread(price_monitor.update_snapshot, snapshot, min(fetched), entries)
+        logger.info(f"📥 Снимок цен из хранилища: {len(snapshot)} товаров, {format_age(min(fetched))}")
+    return len(snapshot)
+
+async def scheduled_monitoring(bot, interval=MONITOR_INTERVAL, jitter=MONITOR_JITTER):
+    """Фоновый опрос источников с заданным интервалом и случайным сдвигом"""
+    logger.info(f"⏰ Фоновый мониторинг: каждые {interval:g} с (+ до {jitter:g} с)")
+    
+    while True:
+        # Случайный сдвиг, чтобы запросы не приходили к магазинам строго по расписанию
+        await asyncio.sleep(random.uniform(0, jitter))
+        try:
+            products, changes = await run_price_check(bot, force=True)
+            logger.info(f"⏰ Фоновая проверка: товаров {len(products)}, изменений {len(changes)}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой проверки цен: {e}")
+        await asyncio.sleep(interval)
+
+# ===== ВЫГРУЗКА ДАННЫХ =====
+EXPORT_COLUMNS = ('id', 'source', 'name', 'price', 'link', 'scraped_at')
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+def parse_period(text):
+    """Начало периода: "7d", "12h", "30m" назад или дата в формате ISO"""
+    units = {'d': 'days', 'h': 'hours', 'm': 'minutes'}
+    if text[:-1].isdigit() and text[-1:] in units:
+        try:
+            return datetime.now() - timedelta(**{units[text[-1]]: int(text[:-1])})
+        except OverflowError:
+            raise ValueError(f"слишком большой период: {text}") from None
+    return datetime.fromisoformat(text)
+
+def parse_export_args(args):
+    """Разбор аргументов вида source=DNS-Shop since=7d format=csv"""
+    options = {'source': None, 'since': None, 'format': 'csv'}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if key not in options or not value:
+            raise ValueError(f"неизвестный аргумент: {arg}")
+        options[key] = value
+    
+    if options['format'] not in EXPORT_FORMATS:
+        raise ValueError(f"формат должен быть одним из: {', '.join(EXPORT_FORMATS)}")
+    if options['since']:
+        options['since'] = parse_period(options['since'])
+    return options
+
+class ExportTooLarge(Exception):
+    """Сжатая выгрузка превысила предельный размер"""
+
+class CappedBuffer(io.BytesIO):
+    """Буфер в памяти, который отказывается расти сверх limit байт"""
+    
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+    
+    def write(self, data):
+        if self.tell() + len(data) > self.limit:
+            raise ExportTooLarge(f"выгрузка больше {self.limit} байт")
+        return super().write(data)
+
+def write_export(stream, rows, export_format):
+    """Потоковая запись строк в gzip-архив; возвращает число записанных строк"""
+    count = 0
+    with gzip.GzipFile(fileobj=stream, mode='wb') as archive:
+        with io.TextIOWrapper(archive, encoding='utf-8', newline='') as text:
+            if export_format == 'csv':
+                writer = csv.writer(text)
+                writer.writerow(EXPORT_COLUMNS)
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in rows:
+                    text.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+                    text.write('\n')
+                    count += 1
+    return count
+
+def build_export(source=None, since=None, export_format='csv', max_bytes=EXPORT_MAX_BYTES):
+    """Сжатая выгрузка из хранилища в память: (байты, число строк).
+    
+    Запись прерывается с ExportTooLarge, как только архив превысит max_bytes.
+    """
+    stream = CappedBuffer(max_bytes)
+    rows = price_monitor.store.iter_prices(source=source, since=since)
+    try:
+        count = write_export(stream, rows, export_format)
+    finally:
+        # Закрывает отдельное соединение чтения и при прерванной записи
+        rows.close()
+    return stream.getvalue(), count
+
 # ===== ОБРАБОТЧИКИ КОМАНД ТЕЛЕГРАМ =====
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start"""
     welcome_text = (
         "🔍 *Мониторинг цен на обогревательные приборы*\n\n"
         "Я отслеживаю цены в интернет-магазинах:\n"
-        "• DNS-Shop\n"
-        "• Citilink\n\n"
+        + "".join(f"• {name}\n" for name in orchestrator.sources) + "\n"
         "*Доступные команды:*\n"
         "/check - проверить текущие цены\n"
         "/monitor - проверить изменения цен\n"
-        "/get_prices - выгрузить файл с данными\n"
+        "/subscribe - получать уведомления об изменениях\n"
+        "/unsubscribe - отключить уведомления\n"
+        "/compare <запрос> - сравнить цены на модель в разных магазинах\n"
+        "/get_prices - выгрузить файл с данными (csv/jsonl)\n"
         "/help - справка\n\n"
         "⚡ *Примечание:* etm.ru блокирует запросы, использую альтернативные источники."
     )
@@ -275,33 +2050,26 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start - начать работу\n"
         "/check - проверить текущие цены\n"
         "/monitor - проверить изменения цен\n"
-        "/get_prices - получить файл с данными\n"
+        "/subscribe - подписаться на уведомления\n"
+        "/unsubscribe - отписаться от уведомлений\n"
+        "/compare <запрос> - лучшая цена на модель по всем магазинам\n"
+        "/get_prices [source=... since=7d format=csv|jsonl] - получить файл с данными\n"
+        "/queue - состояние очереди запросов\n"
         "/help - эта справка\n\n"
         "*Источники данных:*\n"
-        "• DNS-Shop - обогреватели\n"
-        "• Citilink - обогреватели\n\n"
+        + "".join(f"• {name} - обогреватели\n" for name in orchestrator.sources) + "\n"
         "📞 Поддержка: @Alex_De_White"
     )
     
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
 async def check_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Проверка текущих цен"""
-    await update.message.reply_text("🔄 Загружаю цены с DNS-Shop и Citilink...")
-    
+    """Проверка текущих цен: ответ из кэша снимков, опрос источников - только при устаревших данных"""
     try:
-        # Пробуем разные источники
-        products = []
+        if not orchestrator.cache.is_warm():
+            await update.message.reply_text(f"🔄 Загружаю цены с {', '.join(orchestrator.sources)}...")
         
-        dns_products = price_monitor.parse_products_dns()
-        if dns_products:
-            products.extend(dns_products)
-            logger.info(f"✅ DNS-Shop: {len(dns_products)} товаров")
-        
-        citilink_products = price_monitor.parse_products_citilink()
-        if citilink_products:
-            products.extend(citilink_products)
-            logger.info(f"✅ Citilink: {len(citilink_products)} товаров")
+        products, _ = await run_price_check(context.bot)
         
         if not products:
             await update.message.reply_text(
@@ -314,25 +2082,10 @@ async def check_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        # Сохраняем цены
-        price_monitor.save_current_prices(products)
-        
-        # Формируем сообщение
-        message = "📊 *Текущие цены на обогреватели:*\n\n"
-        
-        for i, product in enumerate(products[:8], 1):
-            source_icon = "🛒" if product.get('source') == 'DNS-Shop' else "🔵"
-            message += f"{i}. {source_icon} *{product['name']}*\n"
-            message += f"   💰 *{product['price']:.0f} руб.*\n"
-            if product.get('source'):
-                message += f"   📍 {product['source']}\n"
-            if product['link']:
-                message += f"   🔗 [Ссылка]({product['link']})\n"
-            message += "\n"
-        
-        message += f"Всего найдено товаров: {len(products)}"
-        
-        await update.message.reply_text(message, parse_mode='Markdown', disable_web_page_preview=True)
+        await update.message.reply_text(
+            format_products_message(products, price_monitor.snapshot_time),
+            parse_mode='Markdown', disable_web_page_preview=True
+        )
         
     except Exception as e:
         logger.error(f"❌ Ошибка при проверке цен: {e}")
@@ -343,96 +2096,303 @@ async def monitor_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔍 Проверяю изменения цен...")
     
     try:
-        # Получаем текущие цены
-        products = []
-        products.extend(price_monitor.parse_products_dns())
-        products.extend(price_monitor.parse_products_citilink())
+        # Получаем текущие цены; подписчики получат изменения отдельной рассылкой
+        products, changes = await run_price_check(context.bot, skip_chat_id=update.effective_chat.id)
         
         if not products:
             await update.message.reply_text("❌ Не удалось загрузить текущие цены.")
             return
         
-        price_monitor.save_current_prices(products)
-        changes = price_monitor.check_price_changes(products)
+        data_age = f"\n🕒 Данные обновлены {format_age(price_monitor.snapshot_time)}"
         
         if not changes:
-            await update.message.reply_text("✅ Значительных изменений цен не обнаружено.")
+            await update.message.reply_text("✅ Значительных изменений цен не обнаружено." + data_age)
             return
         
-        # Формируем сообщение об изменениях
-        message = "🚨 *Обнаружены изменения цен!*\n\n"
-        
-        for change in changes[:8]:
-            direction = "📈" if change['change_percent'] > 0 else "📉"
-            source_icon = "🛒" if change.get('source') == 'DNS-Shop' else "🔵"
-            message += f"{direction} {source_icon} *{change['name']}*\n"
-            message += f"   Было: {change['previous_price']:.0f} руб.\n"
-            message += f"   Стало: {change['current_price']:.0f} руб.\n"
-            message += f"   Изменение: {change['change_percent']:+.1f}%\n"
-            if change.get('source'):
-                message += f"   📍 {change['source']}\n"
-            message += "\n"
-        
-        if len(changes) > 8:
-            message += f"... и еще {len(changes) - 8} изменений"
-        
-        await update.message.reply_text(message, parse_mode='Markdown', disable_web_page_preview=True)
+        await update.message.reply_text(
+            format_changes_message(changes) + data_age, parse_mode='Markdown', disable_web_page_preview=True
+        )
         
     except Exception as e:
         logger.error(f"❌ Ошибка при мониторинге цен: {e}")
         await update.message.reply_text("❌ Произошла ошибка при проверке изменений.")
 
+async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подписка чата на уведомления об изменениях цен"""
+    try:
+        added = await asyncio.to_thread(price_monitor.store.add_subscriber, update.effective_chat.id)
+        if added:
+            await update.message.reply_text("🔔 Вы подписаны на уведомления об изменениях цен.")
+        else:
+            await update.message.reply_text("ℹ️ Вы уже подписаны на уведомления.")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при подписке: {e}")
+        await update.message.reply_text("❌ Не удалось оформить подписку, попробуйте позже.")
+
+async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отписка чата от уведомлений"""
+    try:
+        removed = await asyncio.to_thread(price_monitor.store.remove_subscriber, update.effective_chat.id)
+        if removed:
+            await update.message.reply_text("🔕 Уведомления отключены.")
+        else:
+            await update.message.reply_text("ℹ️ Вы не были подписаны на уведомления.")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при отписке: {e}")
+        await update.message.reply_text("❌ Не удалось отключить уведомления, попробуйте позже.")
+
 async def get_prices_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Выгрузка файла с данными цен"""
+    """Выгрузка цен в сжатом CSV или JSONL: /get_prices source=DNS-Shop since=7d format=csv"""
     try:
-        if not os.path.exists(PRICES_FILE):
-            await update.message.reply_text("❌ Файл с ценами еще не создан. Сначала выполните команду /check")
+        options = parse_export_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ Некорректные параметры: {e}\n\n"
+            "Пример: /get_prices source=DNS-Shop since=7d format=csv\n"
+            "• source - магазин (по умолчанию все)\n"
+            "• since - история за период (7d, 12h, 30m или дата); без него - последние цены\n"
+            "• format - csv или jsonl"
+        )
+        return
+    
+    try:
+        data, rows = await asyncio.to_thread(
+            build_export, options['source'], options['since'], options['format']
+        )
+        if not rows:
+            await update.message.reply_text("❌ Нет данных для выгрузки. Сначала выполните команду /check")
             return
         
-        with open(PRICES_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        temp_filename = f"prices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(temp_filename, 'w', encoding='utf-8') as temp_file:
-            json.dump(data, temp_file, ensure_ascii=False, indent=2, sort_keys=True)
-        
-        with open(temp_filename, 'rb') as file_to_send:
-            await update.message.reply_document(
-                document=file_to_send,
-                filename=temp_filename,
-                caption="📄 Файл с данными о ценах на обогреватели"
-            )
-        
-        os.remove(temp_filename)
+        filename = f"prices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{options['format']}.gz"
+        await update.message.reply_document(
+            document=data,
+            filename=filename,
+            caption="📄 Файл с данными о ценах на обогреватели"
+        )
         
+        period = f"с {options['since'].strftime('%d.%m.%Y %H:%M')}" if options['since'] else "последние цены"
         stats_message = (
-            f"📊 *Статистика данных:*\n"
-            f"• Товаров в базе: {len(data)}\n"
-            f"• Последнее обновление: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
-            f"• Размер файла: {os.path.getsize(PRICES_FILE)} байт"
+            f"📊 *Статистика выгрузки:*\n"
+            f"• Строк: {rows}\n"
+            f"• Источник: {options['source'] or 'все'}\n"
+            f"• Период: {period}\n"
+            f"• Размер файла: {len(data)} байт"
         )
         await update.message.reply_text(stats_message, parse_mode='Markdown')
         
+    except ExportTooLarge:
+        await update.message.reply_text(
+            f"❌ Файл больше {EXPORT_MAX_BYTES} байт. Сузьте выборку параметрами source и since."
+        )
     except Exception as e:
         logger.error(f"❌ Ошибка при выгрузке файла: {e}")
         await update.message.reply_text("❌ Произошла ошибка при выгрузке файла.")
 
+async def compare_prices(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сравнение цен по магазинам: поиск по индексу последнего снимка, без опроса источников"""
+    query = ' '.join(context.args or [])
+    if not query:
+        await update.message.reply_text(
+            "ℹ️ Укажите модель или часть названия.\n\nПример: /compare ballu 2000"
+        )
+        return
+    
+    try:
+        match_index = price_monitor.match_index
+        if not len(match_index):
+            await update.message.reply_text("❌ Цены еще не загружены. Сначала выполните команду /check")
+            return
+        
+        results = match_index.search(query)
+        if not results:
+            await update.message.reply_text(f"🔍 По запросу «{query}» ничего не найдено.")
+            return
+        
+        # Запрос и названия товаров - текст пользователя и магазина: экранируются и не попадают внутрь *...*
+        message = f"🔍 *Лучшие цены по запросу* «{escape_markdown(query)}»:\n\n"
+        for i, offers in enumerate(results, 1):
+            best = offers[0]
+            message += f"{i}. {escape_markdown(best.name)}\n"
+            message += f"   💰 *{best.price:.0f} руб.* - {source_icon(best.source)} {escape_markdown(best.source)}\n"
+            if len(offers) > 1:
+                message += f"   🏪 Предложений: {len(offers)}, самое дорогое {offers[-1].price:.0f} руб.\n"
+            # У части магазинов нет ссылки на товар - берем ссылку того же товара в другом магазине
+            link = next((offer.link for offer in offers if offer.link), '')
+            if link:
+                message += f"   🔗 [Ссылка]({link})\n"
+            message += "\n"
+        message += f"🕒 Данные обновлены {format_age(price_monitor.snapshot_time)}"
+        
+        await update.message.reply_text(message, parse_mode='Markdown', disable_web_page_preview=True)
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка при сравнении цен: {e}")
+        await update.message.reply_text("❌ Произошла ошибка при сравнении цен.")
+
+async def queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Состояние очереди команд: глубина, ожидание и время выполнения"""
+    await update.message.reply_text(work_queue.report(), parse_mode='Markdown')
+
+# ===== ОЧЕРЕДЬ ТЯЖЕЛЫХ КОМАНД =====
+class CommandStats:
+    """Задержки последних выполнений команды"""
+    
+    def __init__(self, window=200):
+        self.count = 0
+        self.failures = 0
+        self.waits = deque(maxlen=window)
+        self.durations = deque(maxlen=window)
+    
+    def record(self, wait, duration, failed=False):
+        self.count += 1
+        self.failures += failed
+        self.waits.append(wait)
+        self.durations.append(duration)
+    
+    @staticmethod
+    def percentile(values, share):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * share))] if ordered else 0.0
+
+class WorkQueue:
+    """Ограниченная очередь тяжелых команд с пулом обработчиков: лишние запросы отклоняются сразу"""
+    
+    def __init__(self, maxsize=WORK_QUEUE_SIZE, workers=WORK_QUEUE_WORKERS):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.stats = {}
+        self.rejected = 0
+        self.in_progress = 0
+        self._queue = None
+        self._tasks = []
+    
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+    
+    def start(self):
+        """Запуск обработчиков (нужен работающий цикл событий)"""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            logger.info(f"✅ Очередь команд: {self.workers} обработчиков, до {self.maxsize} задач")
+    
+    async def stop(self):
+        """Остановка обработчиков"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+    
+    def submit(self, command, job):
+        """Постановка задачи в очередь; возвращает позицию или None, если очередь заполнена"""
+        self.start()
+        try:
+            self._queue.put_nowait((command, job, time.monotonic()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            COMMANDS_REJECTED.inc(command=command)
+            logger.warning(f"⚠️ Очередь заполнена, команда /{command} отклонена")
+            return None
+        return self._queue.qsize()
+    
+    async def _worker(self):
+        while True:
+            command, job, enqueued_at = await self._queue.get()
+            started = time.monotonic()
+            failed = False
+            self.in_progress += 1
+            try:
+                await job()
+            except Exception as e:
+                failed = True
+                logger.error(f"❌ Ошибка выполнения /{command}: {e}")
+            finally:
+                self.in_progress -= 1
+                self.stats.setdefault(command, CommandStats()).record(
+                    started - enqueued_at, time.monotonic() - started, failed
+                )
+                self._queue.task_done()
+    
+    def report(self):
+        """Текстовая сводка для команды /queue"""
+        lines = [
+            "📥 *Очередь команд*",
+            f"• В очереди: {self.depth} из {self.maxsize}",
+            f"• Выполняется: {self.in_progress} (обработчиков: {self.workers})",
+            f"• Отклонено при перегрузке: {self.rejected}",
+        ]
+        for command, stats in sorted(self.stats.items()):
+            # Подчеркивание в имени команды экранируется для Markdown
+            lines.append(
+                f"\n/{command.replace('_', chr(92) + '_')} - выполнено {stats.count}, ошибок {stats.failures}\n"
+                f"   ожидание: сред. {sum(stats.waits) / len(stats.waits):.2f} с, "
+                f"p95 {stats.percentile(stats.waits, 0.95):.2f} с\n"
+                f"   выполнение: сред. {sum(stats.durations) / len(stats.durations):.2f} с, "
+                f"p95 {stats.percentile(stats.durations, 0.95):.2f} с"
+            )
+        return "\n".join(lines)
+
+work_queue = WorkQueue()
+
+def queued(command, handler):
+    """Обработчик, который только ставит команду в очередь и сразу освобождает обработку обновлений"""
+    @functools.wraps(handler)
+    async def enqueue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        position = work_queue.submit(command, functools.partial(handler, update, context))
+        if position is None:
+            await update.message.reply_text("⏳ Бот перегружен запросами, попробуйте через минуту.")
+        elif position > 1:
+            await update.message.reply_text(f"⏳ Запрос в очереди, позиция: {position}")
+    return enqueue
+
 # ===== ВЕБХУК ЭНДПОИНТЫ =====
 async def webhook(request: Request) -> Response:
     """Эндпоинт для вебхуков от Telegram"""
+    from starlette.responses import Response
+    
+    startup.mark_once("first_update")
     try:
         data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.update_queue.put(update)
-        return Response()
+        if startup.ready:
+            enqueue_update(data)
+        else:
+            # Обновление, пришедшее во время запуска (часто именно оно будит сервис), обработаем после него
+            startup.defer(data)
     except Exception as e:
         logger.error(f"❌ Ошибка в вебхуке: {e}")
-        return Response(status_code=500)
+    # Telegram всегда получает 200 сразу, иначе будет повторять то же обновление
+    return Response()
+
+def enqueue_update(data):
+    """Передача обновления Telegram в очередь приложения"""
+    from telegram import Update
+    application.update_queue.put_nowait(Update.de_json(data, application.bot))
 
 async def health_check(request: Request) -> PlainTextResponse:
-    """Эндпоинт для проверки здоровья приложения"""
+    """Эндпоинт для проверки здоровья приложения (отвечает сразу после открытия порта)"""
+    from starlette.responses import PlainTextResponse
+    startup.mark_once("first_healthcheck")
     return PlainTextResponse("OK")
 
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """Метрики в текстовом формате Prometheus"""
+    from starlette.responses import PlainTextResponse
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+async def readiness_check(request: Request) -> PlainTextResponse:
+    """Готовность: STARTING (503) до запуска бота, DEGRADED (503), если все источники перестали отдавать товары"""
+    from starlette.responses import PlainTextResponse
+    if not startup.ready:
+        return PlainTextResponse("STARTING", status_code=503)
+    if orchestrator.degraded():
+        failing = ", ".join(
+            f"{name}: {orchestrator.health[name]['failures']}" for name in orchestrator.sources
+        )
+        return PlainTextResponse(f"DEGRADED ({failing})", status_code=503)
+    return PlainTextResponse("READY")
+
 async def set_webhook():
     """Установка вебхука при запуске"""
     if WEBHOOK_URL:
@@ -447,52 +2407,157 @@ async def set_webhook():
 # ===== РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ =====
 def setup_handlers():
     """Регистрация всех обработчиков"""
+    from telegram.ext import CommandHandler
+    
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("check", check_prices))
-    application.add_handler(CommandHandler("monitor", monitor_prices))
-    application.add_handler(CommandHandler("get_prices", get_prices_file))
+    application.add_handler(CommandHandler("check", queued("check", check_prices)))
+    application.add_handler(CommandHandler("monitor", queued("monitor", monitor_prices)))
+    application.add_handler(CommandHandler("subscribe", subscribe))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
+    application.add_handler(CommandHandler("get_prices", queued("get_prices", get_prices_file)))
+    application.add_handler(CommandHandler("compare", compare_prices))
+    application.add_handler(CommandHandler("queue", queue_status))
     logger.info("✅ Все обработчики команд зарегистрированы")
 
 # ===== ЗАПУСК ПРИЛОЖЕНИЯ =====
+class Startup:
+    """Этапы запуска: время от начала загрузки модуля и готовность бота к обработке обновлений"""
+    
+    def __init__(self, started_at=MODULE_STARTED_AT):
+        self.started_at = started_at
+        self.stages = {}
+        self.ready = False
+        self.pending = []
+    
+    def mark(self, stage):
+        """Отметка этапа запуска в журнале и метриках"""
+        seconds = time.perf_counter() - self.started_at
+        self.stages[stage] = seconds
+        logger.info(f"⏱ Запуск: {stage} через {seconds:.3f} с")
+    
+    def mark_once(self, stage):
+        if stage not in self.stages:
+            self.mark(stage)
+    
+    def defer(self, data, limit=STARTUP_UPDATE_BUFFER):
+        """Обновление, пришедшее до готовности бота; сверх лимита отбрасывается"""
+        if len(self.pending) >= limit:
+            logger.warning(f"⚠️ Запуск не завершен, буфер обновлений заполнен ({limit}): обновление отброшено")
+            return
+        self.pending.append(data)
+    
+    def set_ready(self, on_pending):
+        """Передача отложенных обновлений и готовность: новые обновления идут сразу в очередь"""
+        pending, self.pending = self.pending, []
+        for data in pending:
+            try:
+                on_pending(data)
+            except Exception as e:
+                logger.error(f"❌ Ошибка отложенного обновления: {e}")
+        if pending:
+            logger.info(f"📨 Передано обновлений, пришедших во время запуска: {len(pending)}")
+        self.ready = True
+        self.mark("ready")
+
+startup = Startup()
+
+async def initialize_bot():
+    """Тяжелая часть запуска, выполняется после открытия порта"""
+    global application
+    
+    logger.info("🔄 Инициализация бота мониторинга цен...")
+    # Импорт python-telegram-bot занимает заметное время - выполняем его вне цикла событий,
+    # чтобы /healthcheck отвечал и во время загрузки
+    await asyncio.to_thread(importlib.import_module, "telegram.ext")
+    application = create_application()
+    logger.info("✅ Приложение Telegram успешно создано")
+    
+    setup_handlers()
+    await application.initialize()
+    await application.start()
+    logger.info("✅ Приложение Telegram инициализировано и запущено")
+    startup.mark("telegram_ready")
+    
+    work_queue.start()
+    
+    try:
+        await preload_snapshot()
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки снимка цен из хранилища: {e}")
+    startup.mark("snapshot_preloaded")
+    
+    startup.set_ready(enqueue_update)
+
+async def register_webhook():
+    """Установка вебхука в фоне: обработка обновлений ее не ждет"""
+    await set_webhook()
+    startup.mark("webhook_set")
+
 async def main():
-    """Основная функция запуска"""
+    """Основная функция запуска: сначала порт и /healthcheck, затем бот"""
+    from starlette.applications import Starlette
+    from starlette.routing import Route
+    import uvicorn
+    
+    monitoring_task = None
+    webhook_task = None
+    
+    # Создаем Starlette приложение
+    starlette_app = Starlette(routes=[
+        Route("/webhook", webhook, methods=["POST"]),
+        Route("/healthcheck", health_check, methods=["GET"]),
+        Route("/ready", readiness_check, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+        Route("/", health_check, methods=["GET"]),
+    ])
+    
+    # Запускаем сервер
+    config = uvicorn.Config(
+        app=starlette_app,
+        host="0.0.0.0",
+        port=PORT,
+        log_level="info"
+    )
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    
     try:
-        logger.info("🔄 Инициализация бота мониторинга цен...")
-        
-        setup_handlers()
-        
-        await application.initialize()
-        await application.start()
-        logger.info("✅ Приложение Telegram инициализировано и запущено")
-        
-        await set_webhook()
-        
-        # Создаем Starlette приложение
-        starlette_app = Starlette(routes=[
-            Route("/webhook", webhook, methods=["POST"]),
-            Route("/healthcheck", health_check, methods=["GET"]),
-            Route("/", health_check, methods=["GET"]),
-        ])
+        while not server.started:
+            if server_task.done():
+                # Порт не открылся - ошибка уже в журнале uvicorn
+                await server_task
+                return
+            await asyncio.sleep(0.01)
+        startup.mark("port_bound")
+        logger.info(f"🤖 Бот мониторинга цен запущен на порту {PORT}")
         
-        # Запускаем сервер
-        config = uvicorn.Config(
-            app=starlette_app,
-            host="0.0.0.0",
-            port=PORT,
-            log_level="info"
-        )
-        server = uvicorn.Server(config)
+        await initialize_bot()
         
-        logger.info(f"🤖 Бот мониторинга цен запущен на порту {PORT}")
         logger.info(f"🌐 Вебхук URL: {WEBHOOK_URL}")
+        webhook_task = asyncio.create_task(register_webhook())
+        
+        if MONITOR_INTERVAL > 0:
+            monitoring_task = asyncio.create_task(scheduled_monitoring(application.bot))
         
-        await server.serve()
+        await server_task
         
     except Exception as e:
         logger.error(f"❌ Критическая ошибка при запуске: {e}")
-        await application.stop()
+        if application is not None and application.running:
+            await application.stop()
         raise
+    finally:
+        for task in (monitoring_task, webhook_task):
+            if task is not None:
+                task.cancel()
+        if not server_task.done():
+            server.should_exit = True
+            await server_task
+        await work_queue.stop()
+        await price_monitor.close()
+
+startup.mark("module_loaded")
 
 if __name__ == "__main__":
     asyncio.run(main())